@@ -0,0 +1,98 @@
+"""
+Sentence-aware splitting of long inputs.
+
+T5 only sees a 512 token window and attention cost grows quadratically with
+length, so long texts are split into sentence-aligned chunks that are
+corrected independently (and batched together) and then stitched back with
+the original whitespace and paragraph breaks.
+"""
+
+import re
+from typing import Callable, List, Tuple
+
+# Whitespace after sentence-final punctuation (optionally closed by a quote or
+# bracket), or any run of whitespace containing a line break
+_SENTENCE_BREAK = re.compile(r"(?:(?<=[.!?])|(?<=[.!?][\"'”’)\]]))\s+|\s*\n\s*")
+_WORD_BREAK = re.compile(r"\s+")
+
+TokenCounter = Callable[[List[str]], List[int]]
+
+
+def split_sentences(text: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """Returns the leading whitespace and (sentence, following whitespace) pairs."""
+    body = text.lstrip()
+    lead = text[:len(text) - len(body)]
+    pieces = []
+    pos = 0
+    for match in _SENTENCE_BREAK.finditer(body):
+        if match.start() > pos:
+            pieces.append((body[pos:match.start()], match.group()))
+        pos = match.end()
+    if pos < len(body):
+        pieces.append((body[pos:], ""))
+    return lead, pieces
+
+
+def _split_words(sentence: str, separator: str, count_tokens: TokenCounter, max_tokens: int) -> List[Tuple[str, str]]:
+    # Last resort for a single sentence longer than the window
+    words = []
+    pos = 0
+    for match in _WORD_BREAK.finditer(sentence):
+        words.append((sentence[pos:match.start()], match.group()))
+        pos = match.end()
+    words.append((sentence[pos:], separator))
+
+    pieces = []
+    current, current_tokens = "", 0
+    for (word, gap), tokens in zip(words, count_tokens([w for w, _ in words])):
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append((current.rstrip(), current[len(current.rstrip()):]))
+            current, current_tokens = "", 0
+        current += word + gap
+        current_tokens += tokens
+    pieces.append((current[:len(current) - len(separator)], separator))
+    return pieces
+
+
+class ChunkedText:
+    def __init__(self, lead: str, chunks: List[Tuple[str, str]]):
+        self.lead = lead
+        self.chunks = chunks
+
+    @property
+    def texts(self) -> List[str]:
+        return [chunk for chunk, _ in self.chunks]
+
+    def join(self, corrected: List[str]) -> str:
+        return self.lead + "".join(text + separator for text, (_, separator) in zip(corrected, self.chunks))
+
+
+def chunk_text(text: str, count_tokens: TokenCounter, max_tokens: int, merge_sentences: bool = True) -> ChunkedText:
+    """Groups consecutive sentences of a paragraph into chunks of at most max_tokens.
+
+    With merge_sentences=False every sentence is its own chunk, which is what
+    incremental re-correction needs to reuse results per sentence.
+    """
+    lead, sentences = split_sentences(text)
+    if not sentences:
+        return ChunkedText("", [(text, "")])
+
+    chunks = []
+    current, current_sep, current_tokens = "", "", 0
+    for (sentence, separator), tokens in zip(sentences, count_tokens([s for s, _ in sentences])):
+        if tokens > max_tokens:
+            if current:
+                chunks.append((current, current_sep))
+                current, current_sep, current_tokens = "", "", 0
+            chunks.extend(_split_words(sentence, separator, count_tokens, max_tokens))
+            continue
+        # Paragraph breaks always end a chunk so they survive untouched
+        if current and (not merge_sentences or "\n" in current_sep or current_tokens + tokens > max_tokens):
+            chunks.append((current, current_sep))
+            current, current_sep, current_tokens = "", "", 0
+        current = current + current_sep + sentence if current else sentence
+        current_sep = separator
+        current_tokens += tokens
+    if current:
+        chunks.append((current, current_sep))
+    return ChunkedText(lead, chunks)
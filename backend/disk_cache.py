@@ -0,0 +1,111 @@
+"""
+Persistent correction cache shared by every worker process.
+
+Backed by a SQLite database in WAL mode so several uvicorn workers can read
+and write it concurrently, and so results survive restarts and deploys.
+Entries are keyed by a SHA-256 of the in-memory cache key (text, model name
+and generation parameters) and evicted least-recently-used once the entry or
+size limit is exceeded.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+from sqlite_store import LazyConnection
+
+EVICTION_CHECK_INTERVAL = 256
+
+
+def hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class DiskCache:
+    def __init__(self, path: str, max_entries: int = 200000, max_bytes: int = 512 * 1024**2):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = LazyConnection(path, self._create_schema)
+
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS corrections ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS corrections_accessed ON corrections (accessed)")
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Returns the cached values for whichever of keys are present."""
+        hashed = {hash_key(key): key for key in keys}
+        digests = list(hashed)
+        rows = []
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(digests), 500):
+                part = digests[start:start + 500]
+                found = self._conn.execute(
+                    f"SELECT key, value FROM corrections WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                if found:
+                    self._conn.execute(
+                        f"UPDATE corrections SET accessed = ? WHERE key IN ({','.join('?' * len(found))})",
+                        [time.time()] + [row[0] for row in found],
+                    )
+                rows.extend(found)
+        self.hits += len(rows)
+        self.misses += len(hashed) - len(rows)
+        return {hashed[key]: value for key, value in rows}
+
+    def put_many(self, items: Dict[str, str]):
+        now = time.time()
+        rows = [(hash_key(key), value, len(key.encode()) + len(value.encode()), now) for key, value in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO corrections VALUES (?, ?, ?, ?)", rows)
+            self._writes += len(rows)
+            if self._writes >= EVICTION_CHECK_INTERVAL:
+                self._writes = 0
+                self._evict()
+
+    def _evict(self):
+        count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM corrections").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        # Drop the least recently used rows until both limits hold, leaving 10% headroom
+        excess = max(count - int(self.max_entries * 0.9), 0)
+        if size > self.max_bytes:
+            excess = max(excess, int(count * (1 - self.max_bytes * 0.9 / size)))
+        self._conn.execute(
+            "DELETE FROM corrections WHERE key IN (SELECT key FROM corrections ORDER BY accessed LIMIT ?)", (excess,)
+        )
+        self.evictions += excess
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM corrections").fetchone()
+        return {
+            "path": self.path,
+            "entries": count,
+            "bytes": size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,8 +1,10 @@
 import os
+import sys
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
 MODEL_NAME = "vennify/t5-base-grammar-correction"
 OUTPUT_DIR = "./local_model"
+ONNX_DIR = "./local_model_onnx"
 
 if __name__ == "__main__":
     print(f"Downloading {MODEL_NAME}...")
@@ -10,6 +12,10 @@ if __name__ == "__main__":
         AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(OUTPUT_DIR)
         AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME).save_pretrained(OUTPUT_DIR)
         print(f"Saved to {OUTPUT_DIR}")
+        # Optional: pre-export for INFERENCE_ENGINE=onnx / onnx-int8
+        if "--onnx" in sys.argv or "--int8" in sys.argv:
+            from onnx_engine import export_onnx
+            print(f"Saved ONNX model to {export_onnx(OUTPUT_DIR, ONNX_DIR, quantize='--int8' in sys.argv)}")
     except Exception as e:
         print(f"Error: {e}")
         exit(1)
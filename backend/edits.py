@@ -0,0 +1,63 @@
+"""
+Word-level edit spans between a text and its correction.
+
+Instead of sending the corrected document back in full (the client already
+has the original), a correction can be described as a few replacements of
+the original: (offset, length, replacement), offsets and lengths counted in
+characters of the original. Both texts are split into word and punctuation
+tokens (each carrying the whitespace after it, which keeps the token count
+and difflib's work down), the common prefix and suffix are stripped (usually
+almost everything) and difflib aligns the rest. Applying the spans from the
+last to the first turns the original into the corrected text.
+"""
+
+import re
+from difflib import SequenceMatcher
+from typing import List
+
+_TOKEN = re.compile(r"\w+\s*|[^\w\s]\s*|\s+")
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text)
+
+
+def edit_spans(original: str, corrected: str) -> List[dict]:
+    """Returns the replacements, in order, that turn original into corrected."""
+    if original == corrected:
+        return []
+    a, b = _tokenize(original), _tokenize(corrected)
+    prefix = 0
+    while prefix < min(len(a), len(b)) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(a), len(b)) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    # Character offset of every token boundary in the original
+    offsets = [0]
+    for token in a:
+        offsets.append(offsets[-1] + len(token))
+    matcher = SequenceMatcher(None, a[prefix:len(a) - suffix], b[prefix:len(b) - suffix], autojunk=False)
+    spans = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        start, end = offsets[prefix + i1], offsets[prefix + i2]
+        replacement = "".join(b[prefix + j1:prefix + j2])
+        # Whitespace both sides end with is not part of the edit
+        while end > start and replacement and original[end - 1] == replacement[-1] and replacement[-1].isspace():
+            end -= 1
+            replacement = replacement[:-1]
+        if spans and spans[-1]["offset"] + spans[-1]["length"] == start:
+            # Touching changes read better as one edit
+            spans[-1]["length"] += end - start
+            spans[-1]["replacement"] += replacement
+        else:
+            spans.append({"offset": start, "length": end - start, "replacement": replacement})
+    return spans
+
+
+def apply_spans(original: str, spans: List[dict]) -> str:
+    for span in reversed(spans):
+        original = original[:span["offset"]] + span["replacement"] + original[span["offset"] + span["length"]:]
+    return original
@@ -0,0 +1,34 @@
+"""
+Fast path for text that is already correct.
+
+Before generating, the corrector is asked how likely it is to copy its input
+unchanged: one teacher-forced pass (encoder plus a single parallel decoder
+pass, no autoregressive loop) scores the input tokens as the output. If even
+the least likely token of the copy clears the threshold the model would, in
+all likelihood, have returned the input verbatim, so generation is skipped.
+"""
+
+from typing import List
+
+
+def identity_scores(model, inputs, targets) -> List[float]:
+    """Returns, per row, the lowest probability the model gives any token of the unchanged text.
+
+    inputs are the tokenized prompts, targets the tokenized texts themselves
+    (both padded, as returned by the tokenizer with return_tensors="pt").
+    """
+    import torch
+
+    target_ids = targets["input_ids"]
+    target_mask = targets["attention_mask"].bool()
+    start = torch.full((target_ids.shape[0], 1), model.config.decoder_start_token_id, dtype=target_ids.dtype)
+    decoder_input_ids = torch.cat([start, target_ids[:, :-1]], dim=1)
+    with torch.inference_mode():
+        logits = model(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            decoder_input_ids=decoder_input_ids,
+        ).logits
+        log_probs = torch.log_softmax(logits.float(), dim=-1).gather(-1, target_ids.unsqueeze(-1)).squeeze(-1)
+        log_probs = log_probs.masked_fill(~target_mask, 0.0)
+        return log_probs.min(dim=1).values.exp().tolist()
@@ -0,0 +1,194 @@
+"""
+Persistent queue of bulk correction jobs.
+
+Jobs and their texts live in a SQLite database (WAL mode, like the disk
+cache) so they survive restarts and can be shared by every serve.py worker.
+A worker claims a job by taking a lease on it and renews the lease after each
+batch it finishes; a job whose lease ran out (its worker crashed or the
+server restarted) is picked up again and resumes from the first unfinished
+text.
+Each job remembers the API client that submitted it, so its texts are fair
+shared in the scheduler under that client's name and weight.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from sqlite_store import LazyConnection
+
+
+class JobStore:
+    def __init__(self, path: str, lease_seconds: float = 120):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._db = LazyConnection(path, self._create_schema)
+
+    @staticmethod
+    def _create_schema(conn: sqlite3.Connection):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT NOT NULL, total INTEGER NOT NULL, "
+            "completed INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "created REAL NOT NULL, updated REAL NOT NULL, lease_until REAL NOT NULL DEFAULT 0, "
+            "client TEXT NOT NULL DEFAULT '', weight REAL NOT NULL DEFAULT 1)"
+        )
+        # Databases created before jobs recorded their client
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (("client", "TEXT NOT NULL DEFAULT ''"), ("weight", "REAL NOT NULL DEFAULT 1")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_items ("
+            "job_id TEXT NOT NULL, idx INTEGER NOT NULL, text TEXT NOT NULL, corrected TEXT, success INTEGER, "
+            "PRIMARY KEY (job_id, idx))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._db.get()
+
+    _COLUMNS = "id, status, total, completed, failed, created, updated"
+
+    @staticmethod
+    def _describe(row) -> dict:
+        job_id, status, total, completed, failed, created, updated = row
+        return {
+            "job_id": job_id,
+            "status": status,
+            "total": total,
+            "completed": completed,
+            "failed": failed,
+            "created_at": created,
+            "updated_at": updated,
+        }
+
+    def create(self, texts: List[str], params: dict, client: str = "", weight: float = 1.0) -> dict:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT INTO jobs (id, status, params, total, created, updated, client, weight) "
+                             "VALUES (?, 'pending', ?, ?, ?, ?, ?, ?)",
+                             (job_id, json.dumps(params), len(texts), now, now, client, weight))
+                conn.executemany("INSERT INTO job_items (job_id, idx, text) VALUES (?, ?, ?)",
+                                 [(job_id, i, text) for i, text in enumerate(texts)])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return self._describe(conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._describe(row) if row else None
+
+    def claim(self) -> Optional[Tuple[str, dict, str, float]]:
+        """Leases the oldest job that is pending or whose lease expired; returns (job_id, params, client, weight)."""
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, params, client, weight FROM jobs WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) "
+                    "ORDER BY created LIMIT 1", (now,)
+                ).fetchone()
+                if row:
+                    conn.execute("UPDATE jobs SET status = 'running', lease_until = ?, updated = ? WHERE id = ?",
+                                 (now + self.lease_seconds, now, row[0]))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return (row[0], json.loads(row[1]), row[2], row[3]) if row else None
+
+    def next_items(self, job_id: str, limit: int) -> List[Tuple[int, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT idx, text FROM job_items WHERE job_id = ? AND success IS NULL ORDER BY idx LIMIT ?",
+                (job_id, limit)
+            ).fetchall()
+
+    def complete_items(self, job_id: str, results: Dict[int, Optional[str]]) -> bool:
+        """Stores results (None for a failed text) and renews the lease; False if the job was deleted."""
+        now = time.time()
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another worker may have taken the job over after a lapsed lease and finished
+                # some of these items already; only the ones still open are counted
+                completed = failed = 0
+                for idx, corrected in results.items():
+                    if conn.execute(
+                        "UPDATE job_items SET corrected = ?, success = ? WHERE job_id = ? AND idx = ? AND success IS NULL",
+                        (corrected, corrected is not None, job_id, idx)
+                    ).rowcount:
+                        completed += 1
+                        failed += corrected is None
+                updated = conn.execute(
+                    "UPDATE jobs SET completed = completed + ?, failed = failed + ?, updated = ?, lease_until = ?, "
+                    "status = CASE WHEN completed + ? >= total THEN 'done' ELSE status END WHERE id = ?",
+                    (completed, failed, now, now + self.lease_seconds, completed, job_id)
+                ).rowcount
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return updated > 0
+
+    def renew(self, job_id: str):
+        # Keeps the lease while a batch is still waiting for the model
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                               (time.time() + self.lease_seconds, job_id))
+
+    def release(self, job_id: str):
+        # Hand an unfinished job back without waiting for its lease to expire
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'pending', lease_until = 0 WHERE id = ? AND status = 'running'",
+                               (job_id,))
+
+    def results(self, job_id: str, after: int = -1, limit: int = 500) -> List[tuple]:
+        """Finished items with idx > after, in order, as (idx, text, corrected, success)."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT idx, text, corrected, success FROM job_items "
+                "WHERE job_id = ? AND idx > ? AND success IS NOT NULL ORDER BY idx LIMIT ?",
+                (job_id, after, limit)
+            ).fetchall()
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                deleted = conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount
+                conn.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return deleted > 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*), COALESCE(SUM(total - completed), 0) FROM jobs GROUP BY status").fetchall()
+        return {
+            "path": self.path,
+            "jobs": {status: count for status, count, _ in rows},
+            "texts_remaining": sum(remaining for _, _, remaining in rows),
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
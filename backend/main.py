@@ -1,14 +1,41 @@
 import time
+import asyncio
 import psutil
 import os
+import sys
 import logging
-from typing import List
-from fastapi import FastAPI, HTTPException, status, Security, Depends
+import uuid
+import threading
+import json
+import re
+from contextvars import ContextVar
+from typing import Callable, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request, status, Security, Depends, Query, WebSocket, WebSocketDisconnect
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, validator
-from transformers import pipeline
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError, validator
 from dotenv import load_dotenv
+from scheduler import LANES, Deadline, DeadlineExceeded, MicroBatcher, QueueFull
+from chunking import ChunkedText, chunk_text
+from cache import CorrectionCache, cache_key
+from disk_cache import DiskCache
+from sessions import SessionStore
+from onnx_engine import load_onnx_pipeline
+from telemetry import REGISTRY, SIZE_BUCKETS
+from tracing import TraceWriter, add_stage, checkpoint, current_trace, span
+from profiling import Profiler, ProfilerBusy
+from jobs import JobStore
+from ratelimit import Client, parse_api_keys
+from edits import edit_spans
+from registry import ModelRegistry
+
+try:
+    import msgpack
+except ImportError:  # Optional; without it every response is JSON
+    msgpack = None
 
 load_dotenv() # Load environment variables from .env file
 
@@ -16,28 +43,227 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 corrector = None
+# Cheaper (name, pipeline) tiers tried before the corrector, smallest first
+cascade = []
+batcher = None
+loader_task = None
+job_task = None
+# HF fast tokenizers raise "Already borrowed" when one instance is used from
+# several threads at once (event loop chunking vs. inference workers)
+tokenizer_lock = threading.Lock()
+readiness = {
+    "state": "starting",  # starting | loading | warming | ready | failed
+    "stage": "",
+    "progress": 0.0,
+    "load_seconds": None,
+    "warmup_seconds": None,
+    "ready_after_seconds": None,
+    "error": None,
+}
+# time.perf_counter() at which loading and warming began, for reporting them while they run
+phase_started = {}
+# Taken at import, so under serve.py it is the parent's start rather than the worker's fork
+PROCESS_STARTED = psutil.Process().create_time()
 
 MODEL_NAME = os.getenv("MODEL_NAME", "vennify/t5-base-grammar-correction")
+INFERENCE_ENGINE = os.getenv("INFERENCE_ENGINE", "pytorch").lower()  # pytorch | onnx | onnx-int8
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./local_model_onnx")
+WARMUP_LENGTHS = [int(n) for n in os.getenv("WARMUP_LENGTHS", "8,32,128").split(",") if n.strip()]
 MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", "5000"))
-MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "64"))
 API_KEY = os.getenv("API_KEY")
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "0")) or None
+SCHEDULER_MAX_BATCH_SIZE = int(os.getenv("SCHEDULER_MAX_BATCH_SIZE", "8"))
+SCHEDULER_MAX_WAIT_MS = int(os.getenv("SCHEDULER_MAX_WAIT_MS", "10"))
+DEFAULT_TIMEOUT_SECONDS = float(os.getenv("DEFAULT_TIMEOUT_SECONDS", "0"))
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1000"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "256"))
+BATCH_BUCKET_SIZE = int(os.getenv("BATCH_BUCKET_SIZE", "16"))
+LONG_TEXT_CHUNKING = os.getenv("LONG_TEXT_CHUNKING", "true").lower() == "true"
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "128"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", "64"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "3600"))
+DISK_CACHE_PATH = os.getenv("DISK_CACHE_PATH", "")
+DISK_CACHE_MAX_ENTRIES = int(os.getenv("DISK_CACHE_MAX_ENTRIES", "200000"))
+DISK_CACHE_MAX_MB = float(os.getenv("DISK_CACHE_MAX_MB", "512"))
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", "1000"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "")
+MAX_JOB_TEXTS = int(os.getenv("MAX_JOB_TEXTS", "100000"))
+JOB_BATCH_SIZE = int(os.getenv("JOB_BATCH_SIZE", "16"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "512"))
+OUTPUT_LENGTH_FACTOR = float(os.getenv("OUTPUT_LENGTH_FACTOR", "1.5"))
+OUTPUT_LENGTH_SLACK = int(os.getenv("OUTPUT_LENGTH_SLACK", "8"))
+NUM_BEAMS = int(os.getenv("NUM_BEAMS", "1"))
+MAX_NUM_BEAMS = int(os.getenv("MAX_NUM_BEAMS", "4"))
+EARLY_STOPPING = os.getenv("EARLY_STOPPING", "true").lower() == "true"
+SPECULATIVE_DECODING = os.getenv("SPECULATIVE_DECODING", "false").lower() == "true"
+SPECULATIVE_MAX_BATCH = int(os.getenv("SPECULATIVE_MAX_BATCH", "4"))
+FASTPATH_THRESHOLD = float(os.getenv("FASTPATH_THRESHOLD", "0"))
+CASCADE_MODELS = [name.strip() for name in os.getenv("CASCADE_MODELS", "").split(",") if name.strip()]
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", "-0.2"))
+# Further models requests may ask for by name: "name" or "alias=name_or_path", comma separated
+MODELS = {MODEL_NAME: MODEL_NAME}
+for entry in os.getenv("MODELS", "").split(","):
+    if entry.strip():
+        alias, _, path = entry.strip().partition("=")
+        MODELS[alias.strip()] = path.strip() or alias.strip()
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))
+# Defaults for every request; part of the cache key since they change the output
+GENERATION_PARAMS = {
+    "max_new_tokens": MAX_NEW_TOKENS,
+    "output_length_factor": OUTPUT_LENGTH_FACTOR,
+    "output_length_slack": OUTPUT_LENGTH_SLACK,
+    "num_beams": NUM_BEAMS,
+    "early_stopping": EARLY_STOPPING,
+}
+
+# Quantised engines can produce different text, so they get their own cache entries
+CACHE_MODEL_ID = MODEL_NAME if INFERENCE_ENGINE == "pytorch" else f"{MODEL_NAME}@{INFERENCE_ENGINE}"
+if CASCADE_MODELS:
+    CACHE_MODEL_ID = f"{'>'.join(CASCADE_MODELS)}>{CACHE_MODEL_ID}@{CASCADE_THRESHOLD}"
+if FASTPATH_THRESHOLD > 0:
+    # So does the fast path, which returns some texts unchanged without generating
+    CACHE_MODEL_ID = f"{CACHE_MODEL_ID}@fastpath{FASTPATH_THRESHOLD}"
+
+cache = CorrectionCache(CACHE_MAX_ENTRIES, int(CACHE_MAX_MB * 1024**2), CACHE_TTL_SECONDS)
+sessions = SessionStore(SESSION_MAX_COUNT, SESSION_TTL_SECONDS)
+disk_cache = DiskCache(DISK_CACHE_PATH, DISK_CACHE_MAX_ENTRIES, int(DISK_CACHE_MAX_MB * 1024**2)) if DISK_CACHE_PATH else None
+traces = TraceWriter(TRACE_FILE, TRACE_SAMPLE_RATE)
+job_store = JobStore(JOBS_DB_PATH, JOB_LEASE_SECONDS) if JOBS_DB_PATH else None
+jobs_submitted = asyncio.Event()
+# Cache key -> (future, shared Deadline, lane) of a chunk that is being generated right now
+inflight = {}
+# Open /ws/correct connections
+sockets = set()
+# time.perf_counter() by which the current request must be answered, if it has a deadline
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+profiler = Profiler()
+# Every servable model; the default one is registered (pinned) once load_model() has run
+models = ModelRegistry(lambda name: load_pipeline(name), int(MODEL_MEMORY_BUDGET_MB * 1024**2))
+
+REQUESTS = REGISTRY.counter("correctly_requests_total", "HTTP requests by endpoint and status code", ["endpoint", "status"])
+ERRORS = REGISTRY.counter("correctly_errors_total", "Requests that failed with a 5xx status", ["endpoint"])
+ITEM_FAILURES = REGISTRY.counter("correctly_batch_item_failures_total", "Batch items that could not be corrected")
+REQUEST_SECONDS = REGISTRY.histogram("correctly_request_duration_seconds", "End-to-end request latency", ["endpoint"])
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("correctly_queue_wait_seconds", "Time a job waited in the inference queue", ["lane"])
+INFERENCE_SECONDS = REGISTRY.histogram("correctly_inference_seconds", "Time to run one dispatched batch through the model")
+BATCH_SIZE = REGISTRY.histogram("correctly_batch_size", "Texts per dispatched batch", buckets=SIZE_BUCKETS)
+INPUT_TOKENS = REGISTRY.counter("correctly_input_tokens_total", "Prompt tokens fed to the model")
+OUTPUT_TOKENS = REGISTRY.counter("correctly_output_tokens_total", "Tokens generated by the model")
+GENERATE_SECONDS = REGISTRY.counter("correctly_generate_seconds_total", "Time spent inside model.generate")
+TOKENS_PER_SECOND = REGISTRY.gauge("correctly_tokens_per_second", "Generated tokens per second in the last generate call")
+DRAFT_TOKENS = REGISTRY.counter("correctly_speculative_draft_tokens_total", "Tokens proposed from the input by speculative decoding")
+ACCEPTED_TOKENS = REGISTRY.counter("correctly_speculative_accepted_tokens_total", "Proposed tokens that matched the model's greedy choice")
+DECODER_STEPS = REGISTRY.counter("correctly_speculative_decoder_steps_total", "Decoder passes run by speculative decoding")
+FASTPATH_CHECKED = REGISTRY.counter("correctly_fastpath_checked_total", "Texts scored by the already-correct fast path")
+FASTPATH_SKIPPED = REGISTRY.counter("correctly_fastpath_skipped_total", "Texts returned unchanged without generation")
+TIER_TEXTS = REGISTRY.counter("correctly_cascade_texts_total", "Texts run through each cascade tier", ["tier"])
+TIER_ACCEPTED = REGISTRY.counter("correctly_cascade_accepted_total", "Texts whose output was taken from each cascade tier", ["tier"])
+TIER_SECONDS = REGISTRY.histogram("correctly_cascade_tier_seconds", "Time to run one bucket through a cascade tier", ["tier"])
+MODEL_READY = REGISTRY.gauge("correctly_model_ready", "1 once the model is loaded and warmed up")
+MODEL_RESIDENT_BYTES = REGISTRY.gauge("correctly_model_resident_bytes", "Memory held by each loaded model", ["model"])
+MODEL_LOAD_SECONDS = REGISTRY.gauge("correctly_model_load_seconds", "How long the resident copy of each model took to load", ["model"])
+MODEL_LOADS = REGISTRY.counter("correctly_model_loads_total", "Model loads, including reloads after eviction", ["model"])
+MODEL_EVICTIONS = REGISTRY.counter("correctly_model_evictions_total", "Models dropped to stay within MODEL_MEMORY_BUDGET_MB", ["model"])
+QUEUE_DEPTH = REGISTRY.gauge("correctly_queue_depth", "Texts waiting for an inference worker")
+BUSY_WORKERS = REGISTRY.gauge("correctly_busy_workers", "Inference workers currently running a batch")
+REJECTED = REGISTRY.counter("correctly_rejected_total", "Requests rejected because the inference queue was full")
+COALESCED = REGISTRY.counter("correctly_coalesced_total", "Chunks that waited for an identical in-flight generation instead of running their own")
+INFLIGHT = REGISTRY.gauge("correctly_inflight_chunks", "Distinct chunks currently being generated")
+DROPPED = REGISTRY.counter("correctly_dropped_texts_total", "Queued texts discarded before dispatch because their caller went away")
+ABANDONED = REGISTRY.counter("correctly_abandoned_texts_total", "Dispatched texts skipped or cut short because their caller went away or their deadline passed")
+EXPIRED = REGISTRY.counter("correctly_deadline_exceeded_total", "Texts that missed their deadline, by where it was noticed", ["stage"])
+WASTED_SECONDS = REGISTRY.counter("correctly_wasted_inference_seconds_total", "Inference time spent on texts whose result was thrown away")
+DISCONNECTED = REGISTRY.counter("correctly_disconnected_total", "Requests cancelled because the client disconnected", ["endpoint"])
+SUPERSEDED = REGISTRY.counter("correctly_superseded_total", "WebSocket corrections cancelled because a newer version of the text arrived")
+SOCKETS = REGISTRY.gauge("correctly_websocket_connections", "Open correction WebSocket connections")
+CACHE_ENTRIES = REGISTRY.gauge("correctly_cache_entries", "Entries in the correction cache", ["cache"])
+CACHE_BYTES = REGISTRY.gauge("correctly_cache_bytes", "Approximate size of the correction cache", ["cache"])
+CACHE_HITS = REGISTRY.counter("correctly_cache_hits_total", "Correction cache hits", ["cache"])
+CACHE_MISSES = REGISTRY.counter("correctly_cache_misses_total", "Correction cache misses", ["cache"])
+CACHE_EVICTIONS = REGISTRY.counter("correctly_cache_evictions_total", "Correction cache evictions", ["cache"])
+CLIENT_TEXTS = REGISTRY.counter("correctly_client_texts_total", "Texts submitted per API client", ["client"])
+RATE_LIMITED = REGISTRY.counter("correctly_rate_limited_total", "Requests rejected by a client's rate limit", ["client"])
 
 api_key_header = APIKeyHeader(name="x-api-key", auto_error=False)
 
+# key -> Client with its scheduling weight and rate limit
+clients = parse_api_keys(os.getenv("API_KEYS", ""), RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
 if API_KEY:
-    logger.info("Authentication Enabled: API Key is set.")
+    clients.setdefault(API_KEY, Client("default", 1.0, RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST))
+anonymous = Client("anonymous", 1.0, RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST)
+
+if clients:
+    logger.info(f"Authentication Enabled: {len(clients)} API key(s) set.")
 else:
     logger.warning("Authentication Disabled: No API Key found in environment.")
 
-async def get_api_key(api_key_header: str = Security(api_key_header)):
-    if not API_KEY:
-        return True
-    if api_key_header == API_KEY:
-        return True
+def authenticate(key: Optional[str]) -> Optional[Client]:
+    if not clients:
+        return anonymous
+    return clients.get(key)
+
+async def get_api_key(api_key_header: str = Security(api_key_header)) -> Client:
+    client = authenticate(api_key_header)
+    if client:
+        return client
     raise HTTPException(status_code=403, detail="Invalid API Key")
 
+def charge(client: Client, texts: int):
+    wait = client.bucket.take(texts)
+    if wait:
+        RATE_LIMITED.inc(client=client.name)
+        raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, "Rate limit exceeded",
+                            headers={"Retry-After": str(max(1, int(wait + 0.999)))})
+    CLIENT_TEXTS.inc(texts, client=client.name)
+
+class GenerationOptions(BaseModel):
+    num_beams: Optional[int] = Field(None, ge=1, description=f"Beam width, 1 for greedy (max {MAX_NUM_BEAMS})")
+    max_new_tokens: Optional[int] = Field(None, ge=1, description=f"Upper bound on generated tokens per sentence chunk (max {MAX_NEW_TOKENS})")
+    early_stopping: Optional[bool] = Field(None, description="Stop beam search once enough finished candidates exist")
+
+    @validator("num_beams")
+    def validate_num_beams(cls, v):
+        if v is not None and v > MAX_NUM_BEAMS:
+            raise ValueError(f"Max num_beams {MAX_NUM_BEAMS} exceeded")
+        return v
+
+    @validator("max_new_tokens")
+    def validate_max_new_tokens(cls, v):
+        if v is not None and v > MAX_NEW_TOKENS:
+            raise ValueError(f"Max max_new_tokens {MAX_NEW_TOKENS} exceeded")
+        return v
+
+RESPONSE_FORMATS = ("full", "edits")
+
+def validate_model_name(v):
+    if v is not None and v not in MODELS:
+        raise ValueError(f"Unknown model, expected one of {', '.join(MODELS)}")
+    return v
+
 class CorrectionRequest(BaseModel):
     text: str = Field(..., description="Text to correct")
+    options: Optional[GenerationOptions] = Field(None, description="Decoding overrides within the server limits")
+    format: str = Field("full", description="'full' returns original and corrected text, 'edits' only the changed spans")
+    model: Optional[str] = Field(None, description=f"Model to use (default {MODEL_NAME}), one of MODELS")
+
+    _validate_model = validator("model", allow_reuse=True)(validate_model_name)
+
+    @validator("format")
+    def validate_format(cls, v):
+        if v not in RESPONSE_FORMATS:
+            raise ValueError(f"Format must be one of {', '.join(RESPONSE_FORMATS)}")
+        return v
 
     @validator("text")
     def validate_text(cls, v):
@@ -49,6 +275,17 @@ class CorrectionRequest(BaseModel):
 
 class BatchCorrectionRequest(BaseModel):
     texts: List[str] = Field(..., description="List of texts")
+    options: Optional[GenerationOptions] = Field(None, description="Decoding overrides within the server limits")
+    format: str = Field("full", description="'full' returns original and corrected text, 'edits' only the changed spans")
+    model: Optional[str] = Field(None, description=f"Model to use (default {MODEL_NAME}), one of MODELS")
+
+    _validate_model = validator("model", allow_reuse=True)(validate_model_name)
+
+    @validator("format")
+    def validate_format(cls, v):
+        if v not in RESPONSE_FORMATS:
+            raise ValueError(f"Format must be one of {', '.join(RESPONSE_FORMATS)}")
+        return v
 
     @validator("texts")
     def validate_texts(cls, v):
@@ -61,13 +298,50 @@ class BatchCorrectionRequest(BaseModel):
                 raise ValueError(f"Invalid text at index {i}")
         return v
 
+class JobRequest(BaseModel):
+    texts: List[str] = Field(..., description="Texts to correct in the background")
+    options: Optional[GenerationOptions] = Field(None, description="Decoding overrides within the server limits")
+    model: Optional[str] = Field(None, description=f"Model to use (default {MODEL_NAME}), one of MODELS")
+
+    _validate_model = validator("model", allow_reuse=True)(validate_model_name)
+
+    @validator("texts")
+    def validate_texts(cls, v):
+        if not v:
+            raise ValueError("List cannot be empty")
+        if len(v) > MAX_JOB_TEXTS:
+            raise ValueError(f"Job size {MAX_JOB_TEXTS} exceeded")
+        for i, text in enumerate(v):
+            if not text.strip() or len(text) > MAX_TEXT_LENGTH:
+                raise ValueError(f"Invalid text at index {i}")
+        return v
+
+class SocketCorrectionRequest(CorrectionRequest):
+    id: str = Field("", max_length=128, description="Field (or document) the text belongs to")
+    version: int = Field(..., ge=0, description="Increases with every edit of the field")
+
+class IncrementalCorrectionRequest(CorrectionRequest):
+    session_id: Optional[str] = Field(None, max_length=128, description="Session id returned by a previous call for this document")
+
+class TextEdit(BaseModel):
+    offset: int
+    length: int
+    replacement: str
+
 class CorrectionResponse(BaseModel):
     success: bool
-    original: str
-    corrected: str
+    # Present in the 'full' format; the 'edits' format returns edits instead
+    original: Optional[str] = None
+    corrected: Optional[str] = None
+    edits: Optional[List[TextEdit]] = None
     processing_time_ms: int
     chars_count: int
 
+class IncrementalCorrectionResponse(CorrectionResponse):
+    session_id: str
+    sentences_total: int
+    sentences_reused: int
+
 class BatchCorrectionResponse(BaseModel):
     success: bool
     results: List[CorrectionResponse]
@@ -75,10 +349,33 @@ class BatchCorrectionResponse(BaseModel):
 class HealthResponse(BaseModel):
     status: str
     model_loaded: bool
+    readiness: dict
+    engine: str
     system: dict
+    inference: dict
+    cache: dict
+    sessions: int
+    disk_cache: dict
+    jobs: dict
+    models: dict
 
 app = FastAPI(title="Grammar Correction API")
 
+# Compressing these would hold events and result lines back in gzip's buffer; Starlette only
+# leaves text/event-stream alone by itself from 0.46 on, and NDJSON never
+STREAMED_PATHS = re.compile(r"/api/correct/stream|/api/jobs/[^/]+/results")
+
+class StreamAwareGZip(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and STREAMED_PATHS.fullmatch(scope["path"]):
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+if GZIP_MIN_BYTES > 0:
+    # Only applied when the client sends Accept-Encoding: gzip
+    app.add_middleware(StreamAwareGZip, minimum_size=GZIP_MIN_BYTES)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -87,70 +384,839 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-async def startup_event():
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    # Endpoints and the inference path add their stage timings to this trace
+    trace = traces.start()
+    current_trace.set(trace)
+    # Seconds the caller is prepared to wait, e.g. its own client timeout
+    try:
+        timeout = float(request.headers.get("x-request-timeout") or DEFAULT_TIMEOUT_SECONDS)
+    except ValueError:
+        timeout = DEFAULT_TIMEOUT_SECONDS
+    request_deadline.set(time.perf_counter() + timeout if timeout > 0 else None)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = trace.server_timing()
+        return response
+    finally:
+        # Label by route template rather than raw path to keep cardinality bounded
+        route = request.scope.get("route")
+        endpoint = route.path if route else "unmatched"
+        REQUESTS.inc(endpoint=endpoint, status=status_code)
+        REQUEST_SECONDS.observe(trace.elapsed(), endpoint=endpoint)
+        if status_code >= 500:
+            ERRORS.inc(endpoint=endpoint)
+        if trace.sampled:
+            record = trace.to_dict(method=request.method, endpoint=endpoint, status=status_code)
+            try:
+                await asyncio.to_thread(traces.write, record)
+            except OSError as e:
+                logger.warning(f"Could not write trace: {e}")
+
+def set_stage(state: str, stage: str, progress: float):
+    readiness.update(state=state, stage=stage, progress=progress)
+    logger.info(f"[{state}] {stage}")
+
+def load_model():
     global corrector
+    start = phase_started["loading"] = time.perf_counter()
     try:
+        # Heavy imports are deferred to here so the server can come up first
+        set_stage("loading", "importing inference libraries", 0.1)
+        from transformers import pipeline
+
         # Prefer local model for offline support
         model_path = "./local_model" if os.path.isdir("./local_model") else MODEL_NAME
-        logger.info(f"Loading model from: {model_path}")
-        corrector = pipeline("text2text-generation", model=model_path, device=-1)
-        logger.info("Model loaded")
+        set_stage("loading", f"loading model from {model_path} ({INFERENCE_ENGINE})", 0.3)
+        if INFERENCE_ENGINE in ("onnx", "onnx-int8"):
+            corrector = load_onnx_pipeline(model_path, ONNX_MODEL_DIR, quantize=INFERENCE_ENGINE == "onnx-int8")
+        else:
+            corrector = pipeline("text2text-generation", model=model_path, device=-1)
+        models.add(MODEL_NAME, corrector, time.perf_counter() - start, pinned=True)
+        for i, name in enumerate(CASCADE_MODELS):
+            set_stage("loading", f"loading cascade tier {i + 1}/{len(CASCADE_MODELS)} from {name}", 0.5)
+            cascade.append((name, pipeline("text2text-generation", model=name, device=-1)))
+        readiness["load_seconds"] = round(time.perf_counter() - start, 2)
+        set_stage("loading", "model loaded", 0.7)
     except Exception as e:
         logger.error(f"Failed to load model: {e}")
         corrector = None
+        cascade.clear()
+        readiness.update(state="failed", error=str(e))
+
+def load_pipeline(name: str):
+    # Loader for the models in MODELS other than the default, with the same engine
+    from transformers import pipeline
+
+    path = MODELS[name]
+    if INFERENCE_ENGINE in ("onnx", "onnx-int8"):
+        # Each model gets its own export next to the default one
+        onnx_dir = ONNX_MODEL_DIR + "-" + re.sub(r"[^\w.-]+", "_", name)
+        return load_onnx_pipeline(path, onnx_dir, quantize=INFERENCE_ENGINE == "onnx-int8")
+    return pipeline("text2text-generation", model=path, device=-1)
+
+WARMUP_WORDS = "she go to the office every day and dont like it".split()
+
+def warmup():
+    # One pass per representative input length so first requests don't pay for lazy init
+    start = phase_started["warming"] = time.perf_counter()
+    for i, words in enumerate(WARMUP_LENGTHS):
+        set_stage("warming", f"warmup pass {i + 1}/{len(WARMUP_LENGTHS)} ({words} words)",
+                  0.7 + 0.3 * i / len(WARMUP_LENGTHS))
+        text = " ".join((WARMUP_WORDS * words)[:words]) + "."
+        generate([text])
+        # The cascade may answer the warmup text itself, so warm every model directly too
+        for _, pipe in cascade:
+            run_model([f"grammar: {text}"], {}, GENERATION_PARAMS, pipe)
+    readiness["warmup_seconds"] = round(time.perf_counter() - start, 2)
+
+def prepare_model():
+    # Already loaded when this worker was forked by serve.py
+    if corrector is None:
+        load_model()
+    if corrector is None:
+        return
+    try:
+        warmup()
+    except Exception as e:
+        logger.warning(f"Warmup failed: {e}")
+    readiness.update(state="ready", stage="ready", progress=1.0,
+                     ready_after_seconds=round(time.time() - PROCESS_STARTED, 2))
+    logger.info(f"Ready {readiness['ready_after_seconds']}s after process start")
+
+def readiness_report() -> dict:
+    # A phase still under way reports how long it has been running so far
+    report = dict(readiness)
+    field = {"loading": "load_seconds", "warming": "warmup_seconds"}.get(readiness["state"])
+    if field and readiness["state"] in phase_started:
+        report[field] = round(time.perf_counter() - phase_started[readiness["state"]], 2)
+    return report
+
+def is_ready() -> bool:
+    return readiness["state"] == "ready"
+
+def require_ready():
+    if not is_ready():
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Model not active", headers={"Retry-After": "5"})
+
+@app.on_event("startup")
+async def startup_event():
+    global batcher, loader_task, job_task
+    batcher = MicroBatcher(profiler.wrap(generate), SCHEDULER_MAX_BATCH_SIZE, SCHEDULER_MAX_WAIT_MS,
+                           workers=INFERENCE_WORKERS, max_queue_size=INFERENCE_QUEUE_SIZE, on_batch=record_batch,
+                           measure=count_tokens)
+    batcher.start()
+    # Load in the background so the server accepts connections (and reports progress) meanwhile
+    loader_task = asyncio.create_task(asyncio.to_thread(prepare_model))
+    if job_store:
+        job_task = asyncio.create_task(run_jobs())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if job_task:
+        job_task.cancel()
+        await asyncio.gather(job_task, return_exceptions=True)
+    if batcher:
+        await batcher.stop()
+    if disk_cache:
+        disk_cache.close()
+    if job_store:
+        job_store.close()
+
+def record_batch(waits: List[Tuple[str, float]], size: int, seconds: float):
+    for lane, wait in waits:
+        QUEUE_WAIT_SECONDS.observe(wait, lane=lane)
+    BATCH_SIZE.observe(size)
+    INFERENCE_SECONDS.observe(seconds)
+
+def generation_params(options: Optional[GenerationOptions], model: Optional[str] = None) -> dict:
+    overrides = {name: value for name, value in options.dict().items() if value is not None} if options else {}
+    if model and model != MODEL_NAME:
+        # Only named for other models, so cache keys of the default model stay as they were
+        overrides["model"] = model
+    return {**GENERATION_PARAMS, **overrides} if overrides else GENERATION_PARAMS
+
+def decoding_kwargs(params: dict, input_tokens: int) -> dict:
+    # A correction is about as long as its input, so the budget follows the
+    # longest prompt in the bucket; runaway repetition stops there
+    budget = int(input_tokens * params["output_length_factor"]) + params["output_length_slack"]
+    kwargs = {"max_new_tokens": max(1, min(params["max_new_tokens"], budget)), "num_beams": params["num_beams"]}
+    if params["num_beams"] > 1:
+        kwargs["early_stopping"] = params["early_stopping"]
+    return kwargs
+
+def sequence_confidence(model, output, pad_token_id: int) -> List[float]:
+    # Mean log-prob per generated token, so long outputs aren't penalised for their length
+    if getattr(output, "sequences_scores", None) is not None:
+        return output.sequences_scores.tolist()
+    scores = model.compute_transition_scores(output.sequences, output.scores, normalize_logits=True)
+    mask = output.sequences[:, -scores.shape[1]:] != pad_token_id
+    totals = scores.masked_fill(~mask, 0.0).sum(dim=1)
+    return (totals / mask.sum(dim=1).clamp(min=1)).tolist()
+
+def run_model(prompts: List[str], stages: dict, params: dict, pipe=None, confidences: Optional[list] = None,
+              abandoned: Optional[Callable[[int], bool]] = None) -> list:
+    # pipe defaults to the corrector; confidences, if given, receives each row's sequence confidence;
+    # with greedy decoding, rows for which abandoned(row) turns true stop generating at the next step and
+    # come back as errors
+    pipe = pipe or corrector
+    tokenizer = pipe.tokenizer
+    start = time.perf_counter()
+    with tokenizer_lock:
+        inputs = tokenizer(prompts, padding=True, truncation=True, max_length=512, return_tensors="pt")
+    add_stage(stages, "tokenize", time.perf_counter() - start)
+    decoding = decoding_kwargs(params, int(inputs["attention_mask"].sum(dim=1).max()))
+    stop = None
+    # Beam search ignores rows stopped on their own, so only greedy decoding cuts them short
+    if abandoned and decoding["num_beams"] == 1:
+        from transformers import StoppingCriteriaList
+        from stopping import Abandoned
+        stop = Abandoned(abandoned)
+        decoding["stopping_criteria"] = StoppingCriteriaList([stop])
+    start = time.perf_counter()
+    # Copy speculation verifies several tokens per decoder pass but decodes row
+    # by row, so it only pays off for greedy decoding of small batches
+    if confidences is not None:
+        output = pipe.model.generate(
+            input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"],
+            output_scores=True, return_dict_in_generate=True, **decoding
+        )
+        output_ids = output.sequences
+        confidences.extend(sequence_confidence(pipe.model, output, tokenizer.pad_token_id))
+    elif (SPECULATIVE_DECODING and INFERENCE_ENGINE == "pytorch" and decoding["num_beams"] == 1
+            and len(prompts) <= SPECULATIVE_MAX_BATCH):
+        from speculative import speculative_generate
+        spec_stats = {}
+        output_ids = speculative_generate(pipe.model, inputs["input_ids"], inputs["attention_mask"],
+                                          decoding["max_new_tokens"], spec_stats, stop and stop.check)
+        DRAFT_TOKENS.inc(spec_stats.get("drafted", 0))
+        ACCEPTED_TOKENS.inc(spec_stats.get("accepted", 0))
+        DECODER_STEPS.inc(spec_stats.get("steps", 0))
+    else:
+        output_ids = pipe.model.generate(
+            input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"], **decoding
+        )
+    elapsed = time.perf_counter() - start
+    add_stage(stages, "generate", elapsed)
+    if stop:
+        ABANDONED.inc(len(stop.stopped))
+    generated = int((output_ids != tokenizer.pad_token_id).sum())
+    INPUT_TOKENS.inc(int(inputs["attention_mask"].sum()))
+    OUTPUT_TOKENS.inc(generated)
+    GENERATE_SECONDS.inc(elapsed)
+    if elapsed > 0:
+        TOKENS_PER_SECOND.set(round(generated / elapsed, 2))
+    start = time.perf_counter()
+    with tokenizer_lock:
+        decoded = tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    add_stage(stages, "detokenize", time.perf_counter() - start)
+    if stop and stop.stopped:
+        # A row cut short holds a truncated correction, which must never pass for a result
+        decoded = [RuntimeError("Stopped early") if row in stop.stopped else text for row, text in enumerate(decoded)]
+    return decoded
+
+def already_correct(texts: List[str], prompts: List[str], stages: dict, pipe=None) -> List[bool]:
+    from fastpath import identity_scores
+
+    pipe = pipe or corrector
+    start = time.perf_counter()
+    try:
+        with tokenizer_lock:
+            inputs = pipe.tokenizer(prompts, padding=True, truncation=True, max_length=512, return_tensors="pt")
+            targets = pipe.tokenizer(texts, padding=True, truncation=True, max_length=512, return_tensors="pt")
+        skip = [score >= FASTPATH_THRESHOLD for score in identity_scores(pipe.model, inputs, targets)]
+    except Exception as e:
+        logger.warning(f"Fast path scoring failed ({e}), generating instead")
+        skip = [False] * len(texts)
+    add_stage(stages, "fastpath", time.perf_counter() - start)
+    FASTPATH_CHECKED.inc(len(texts))
+    FASTPATH_SKIPPED.inc(sum(skip))
+    return skip
+
+def generate(texts: List[str], timings: Optional[dict] = None, params: Optional[List[Optional[dict]]] = None,
+             abandoned: Optional[Callable[[int], bool]] = None) -> list:
+    # Per-stage seconds for the whole call are added to timings, if given;
+    # params holds each text's generation parameters (None for the defaults);
+    # texts for which abandoned(i) is true are skipped or cut short
+    abandoned = abandoned or (lambda i: False)
+    stages = {} if timings is None else timings
+    params = [p or GENERATION_PARAMS for p in params] if params else [GENERATION_PARAMS] * len(texts)
+    # T5-base specific prefix expectation
+    prompts = [f"grammar: {text}" for text in texts]
+    # Sort by token length so each bucket pads to roughly its own length
+    start = time.perf_counter()
+    with tokenizer_lock:
+        encoded = corrector.tokenizer(prompts, truncation=True, max_length=512)["input_ids"]
+    add_stage(stages, "tokenize", time.perf_counter() - start)
+    lengths = [len(ids) for ids in encoded]
+    # Texts with different generation parameters can't share a generate call
+    groups = {}
+    for i, p in enumerate(params):
+        groups.setdefault(json.dumps(p, sort_keys=True), []).append(i)
+    results = [None] * len(prompts)
+
+    def wanted(bucket: List[int]) -> List[int]:
+        # Drop texts whose caller went away while earlier buckets or tiers ran
+        kept = [i for i in bucket if not abandoned(i)]
+        for i in set(bucket).difference(kept):
+            results[i] = RuntimeError("Caller went away")
+        ABANDONED.inc(len(bucket) - len(kept))
+        return kept
+
+    for indices in groups.values():
+        order = sorted(indices, key=lengths.__getitem__)
+        group_params = params[order[0]]
+        model_name = group_params.get("model", MODEL_NAME)
+        try:
+            # Normally loaded already (correct_chunks waits for it), unless it was evicted since
+            pipe = models.get(model_name)
+        except Exception as e:
+            logger.error(f"Failed to load model {model_name}: {e}")
+            for i in order:
+                results[i] = e
+            continue
+        # The cascade sits in front of the default model; a named model answers directly
+        tiers = cascade if model_name == MODEL_NAME else []
+        for start in range(0, len(order), BATCH_BUCKET_SIZE):
+            bucket = wanted(order[start:start + BATCH_BUCKET_SIZE])
+            if not bucket:
+                continue
+            if FASTPATH_THRESHOLD > 0:
+                # Text the model would copy verbatim anyway is returned as is
+                skip = already_correct([texts[i] for i in bucket], [prompts[i] for i in bucket], stages, pipe)
+                for i, unchanged in zip(bucket, skip):
+                    if unchanged:
+                        results[i] = texts[i]
+                bucket = [i for i, unchanged in zip(bucket, skip) if not unchanged]
+                if not bucket:
+                    continue
+            # Each cascade tier keeps the outputs it is confident about and
+            # passes the rest up; the corrector answers whatever is left
+            for name, tier in tiers:
+                confidences = []
+                outputs = run_bucket([prompts[i] for i in bucket], stages, group_params, name, tier, confidences,
+                                     lambda row, bucket=bucket: abandoned(bucket[row]))
+                escalated = []
+                for i, output, confidence in zip(bucket, outputs, confidences):
+                    if isinstance(output, str) and confidence >= CASCADE_THRESHOLD:
+                        results[i] = output
+                    else:
+                        escalated.append(i)
+                TIER_ACCEPTED.inc(len(bucket) - len(escalated), tier=name)
+                bucket = wanted(escalated)
+                if not bucket:
+                    break
+            if not bucket:
+                continue
+            outputs = run_bucket([prompts[i] for i in bucket], stages, group_params, model_name, pipe, None,
+                                 lambda row, bucket=bucket: abandoned(bucket[row]))
+            if tiers:
+                TIER_ACCEPTED.inc(sum(isinstance(output, str) for output in outputs), tier=MODEL_NAME)
+            for i, output in zip(bucket, outputs):
+                results[i] = output
+    return results
+
+def run_bucket(prompts: List[str], stages: dict, params: dict, tier: str, pipe=None,
+               confidences: Optional[list] = None, abandoned: Optional[Callable[[int], bool]] = None) -> list:
+    start = time.perf_counter()
+    try:
+        outputs = run_model(prompts, stages, params, pipe, confidences, abandoned)
+    except Exception as e:
+        # Retry one by one so a single bad input doesn't fail its neighbours
+        logger.warning(f"Bucket of {len(prompts)} failed ({e}), retrying items individually")
+        outputs = []
+        if confidences is not None:
+            confidences.clear()
+        for row, prompt in enumerate(prompts):
+            single = (lambda _, row=row: abandoned(row)) if abandoned else None
+            try:
+                outputs.append(run_model([prompt], stages, params, pipe, confidences, single)[0])
+            except Exception as item_error:
+                outputs.append(item_error)
+                if confidences is not None:
+                    confidences.append(float("-inf"))
+    if cascade and not params.get("model"):
+        TIER_TEXTS.inc(len(prompts), tier=tier)
+        TIER_SECONDS.observe(time.perf_counter() - start, tier=tier)
+    return outputs
+
+def count_tokens(texts: List[str]) -> List[int]:
+    with tokenizer_lock:
+        encoded = corrector.tokenizer(texts, add_special_tokens=False)["input_ids"]
+    return [len(ids) for ids in encoded]
+
+def split_text(text: str) -> ChunkedText:
+    if LONG_TEXT_CHUNKING:
+        # Long inputs are split into sentence chunks that are corrected as one batch
+        return chunk_text(text, count_tokens, CHUNK_MAX_TOKENS)
+    return ChunkedText("", [(text, "")])
+
+async def correct_chunks(chunks: List[str], params: dict = GENERATION_PARAMS, client: Client = anonymous,
+                         lane: str = "interactive") -> list:
+    trace = current_trace.get()
+    with span("cache"):
+        keys = [cache_key(chunk, CACHE_MODEL_ID, params) for chunk in chunks]
+        outputs = [cache.get(key) if cache.enabled else None for key in keys]
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        if misses and disk_cache:
+            stored = await asyncio.to_thread(disk_cache.get_many, [keys[i] for i in misses])
+            for i in misses:
+                if keys[i] in stored:
+                    outputs[i] = stored[keys[i]]
+                    cache.put(keys[i], outputs[i])
+            misses = [i for i in misses if outputs[i] is None]
+    if not misses:
+        return outputs
+
+    # Single-flight: a chunk already being generated (by another request or
+    # earlier in this one) is waited for instead of generated again, as long as
+    # it was queued at this priority or above
+    loop = asyncio.get_running_loop()
+    deadline = request_deadline.get()
+    shared = Deadline(deadline)
+    owned, waiting, futures = {}, {}, {}
+    for i in misses:
+        if keys[i] in owned:
+            owned[keys[i]].append(i)
+        # The owner's job must now also last as long as this request needs it; once
+        # its deadline has passed its rows may be cut short, so generate afresh
+        elif (keys[i] in inflight and LANES.index(inflight[keys[i]][2]) <= LANES.index(lane)
+                and inflight[keys[i]][1].extend(deadline)):
+            waiting[i] = inflight[keys[i]][0]
+        else:
+            owned[keys[i]] = [i]
+            futures[keys[i]] = loop.create_future()
+            inflight[keys[i]] = (futures[keys[i]], shared, lane)
+    COALESCED.inc(len(misses) - len(owned))
+    try:
+        if owned:
+            if "model" in params and not models.loaded(params["model"]):
+                # Load before queueing so the inference workers never stall on it
+                with span("load"):
+                    await asyncio.to_thread(models.get, params["model"])
+            generated = await batcher.submit([chunks[indices[0]] for indices in owned.values()],
+                                             trace.stages if trace else None, params, lane, client.name, client.weight,
+                                             shared)
+            fresh = {}
+            for (key, indices), output in zip(owned.items(), generated):
+                for i in indices:
+                    outputs[i] = output
+                if isinstance(output, str):
+                    cache.put(key, output)
+                    fresh[key] = output
+                futures[key].set_result(output)
+            if fresh and disk_cache:
+                with span("cache"):
+                    await asyncio.to_thread(disk_cache.put_many, fresh)
+            # Waiters may have kept the job going past this request's own deadline
+            if deadline is not None and time.perf_counter() > deadline:
+                raise DeadlineExceeded()
+    except BaseException as e:
+        for future in futures.values():
+            if future.done():
+                continue
+            if isinstance(e, (asyncio.CancelledError, DeadlineExceeded)):
+                # Waiters notice the cancelled future and run the chunk themselves,
+                # under their own deadline
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # Marks it retrieved in case nobody was waiting
+        raise
+    finally:
+        for key, future in futures.items():
+            # Unless a later request took the key over from this one
+            if inflight.get(key, (None,))[0] is future:
+                del inflight[key]
+    for i, future in waiting.items():
+        outputs[i] = await await_inflight(future, chunks[i], params, client, lane)
+    return outputs
+
+async def await_inflight(future: asyncio.Future, chunk: str, params: dict, client: Client, lane: str):
+    try:
+        # Shielded so a waiter going away (or running out of time) doesn't cancel the work for everyone else
+        deadline = request_deadline.get()
+        return await asyncio.wait_for(asyncio.shield(future), deadline - time.perf_counter() if deadline else None)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded()
+    except asyncio.CancelledError:
+        if future.cancelled():
+            # The request that owned the generation went away; run it ourselves
+            return (await correct_chunks([chunk], params, client, lane))[0]
+        raise
+
+async def correct_texts(texts: List[str], params: dict = GENERATION_PARAMS, client: Client = anonymous,
+                        lane: str = "interactive") -> list:
+    with span("chunk"):
+        documents = [split_text(text) for text in texts]
+    outputs = await correct_chunks([chunk for doc in documents for chunk in doc.texts], params, client, lane)
+    results = []
+    offset = 0
+    for doc in documents:
+        corrected = outputs[offset:offset + len(doc.chunks)]
+        offset += len(doc.chunks)
+        failed = next((c for c in corrected if isinstance(c, Exception)), None)
+        results.append(failed if failed is not None else doc.join(corrected))
+    return results
+
+def busy_error(e: QueueFull) -> HTTPException:
+    return HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Server busy, retry later",
+                         headers={"Retry-After": str(e.retry_after)})
+
+def deadline_error() -> HTTPException:
+    return HTTPException(status.HTTP_504_GATEWAY_TIMEOUT, "Request deadline exceeded")
+
+async def wait_disconnect(request: Request):
+    # The body has been read already, so the next message is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+async def unless_disconnected(request: Request, work):
+    # Runs work, cancelling it (and with it any queued or running generation) if the client hangs up
+    task = asyncio.create_task(work)
+    watcher = asyncio.create_task(wait_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        route = request.scope.get("route")
+        DISCONNECTED.inc(endpoint=route.path if route else "unmatched")
+        raise HTTPException(499, "Client closed request")
+    finally:
+        task.cancel()
+        watcher.cancel()
 
-def process_text(text: str) -> dict:
-    if not corrector:
-        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "Model not active")
+async def process_text(text: str, params: dict = GENERATION_PARAMS, client: Client = anonymous) -> dict:
+    checkpoint("validate")
+    require_ready()
     
-    start = time.time()
+    start = time.perf_counter()
     try:
-        # T5-base specific prefix expectation
-        prompt = f"grammar: {text}"
-        res = corrector(prompt, max_length=512)
-        corrected = res[0]['generated_text']
+        corrected = (await correct_texts([text], params, client))[0]
+        if isinstance(corrected, Exception):
+            raise corrected
         
         return {
             "success": True,
             "original": text,
             "corrected": corrected,
-            "processing_time_ms": int((time.time() - start) * 1000),
+            "processing_time_ms": int((time.perf_counter() - start) * 1000),
             "chars_count": len(text)
         }
+    except QueueFull as e:
+        raise busy_error(e)
+    except DeadlineExceeded:
+        raise deadline_error()
     except Exception as e:
         logger.error(f"Processing error: {e}")
         raise HTTPException(500, f"Error: {str(e)}")
 
+def shape(result: dict, format: str) -> dict:
+    # The client has the original already, so the edits format sends only what changed
+    if format != "edits":
+        return result
+    compact = {key: value for key, value in result.items() if key not in ("original", "corrected")}
+    compact["edits"] = edit_spans(result["original"], result["corrected"]) if result["success"] else []
+    return compact
+
+async def shape_off_loop(result: dict, format: str) -> dict:
+    # Aligning a long document takes milliseconds, so it runs off the event loop
+    if format != "edits":
+        return result
+    return await asyncio.to_thread(shape, result, format)
+
+def encode(request: Request, response: Response, payload: dict):
+    # Content negotiation: MessagePack if asked for (and installed), JSON otherwise;
+    # either way caches must key the response on Accept
+    if msgpack and "msgpack" in request.headers.get("accept", ""):
+        return Response(msgpack.packb(payload), media_type="application/msgpack", headers={"Vary": "Accept"})
+    response.headers["Vary"] = "Accept"
+    return payload
+
 @app.get("/", response_model=dict)
 async def root():
     return {"message": "Grammar Correction API", "docs": "/docs", "health": "/health"}
 
+def process_memory() -> dict:
+    proc = psutil.Process()
+    try:
+        info = proc.memory_full_info()
+    except psutil.AccessDenied:
+        info = proc.memory_info()
+    stats = {"pid": proc.pid, "worker_id": os.getenv("WORKER_ID")}
+    # shared/uss/pss are platform dependent; pages shared with forked siblings show up in shared
+    for field in ("rss", "uss", "pss", "shared"):
+        if hasattr(info, field):
+            stats[f"{field}_mb"] = round(getattr(info, field) / (1024**2), 2)
+    # torch may still be mid-import while the model loads in the background
+    torch = sys.modules.get("torch")
+    if torch and corrector is not None:
+        stats["intra_op_threads"] = torch.get_num_threads()
+    return stats
+
+@app.get("/ready")
+async def ready():
+    if not is_ready():
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, readiness_report(), headers={"Retry-After": "5"})
+    return readiness_report()
+
 @app.get("/health", response_model=HealthResponse)
 async def health():
     mem = psutil.virtual_memory()
     return {
-        "status": "healthy" if corrector else "loading",
+        "status": "healthy" if is_ready() else readiness["state"],
         "model_loaded": corrector is not None,
+        "readiness": readiness_report(),
+        "engine": INFERENCE_ENGINE,
         "system": {
             "memory_used_mb": round(mem.used / (1024**2), 2),
             "memory_percent": mem.percent,
-            "cpu_count": psutil.cpu_count()
-        }
+            "cpu_count": psutil.cpu_count(),
+            "process": await asyncio.to_thread(process_memory)
+        },
+        "inference": batcher.stats() if batcher else {},
+        "cache": cache.stats(),
+        "sessions": len(sessions),
+        "disk_cache": await asyncio.to_thread(disk_cache.stats) if disk_cache else {},
+        "jobs": await asyncio.to_thread(job_store.stats) if job_store else {},
+        "models": models.stats()
     }
 
-@app.post("/api/correct", response_model=CorrectionResponse, dependencies=[Depends(get_api_key)])
-async def correct(req: CorrectionRequest):
-    return process_text(req.text)
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    MODEL_READY.set(1 if is_ready() else 0)
+    if batcher:
+        stats = batcher.stats()
+        QUEUE_DEPTH.set(stats["queue_depth"])
+        BUSY_WORKERS.set(stats["busy_workers"])
+        INFLIGHT.set(len(inflight))
+        SOCKETS.set(len(sockets))
+        REJECTED.set_total(stats["rejected"])
+        DROPPED.set_total(stats["dropped"])
+        WASTED_SECONDS.set_total(stats["wasted_seconds"])
+        for stage, count in stats["expired"].items():
+            EXPIRED.set_total(count, stage=stage)
+    registry = models.stats()
+    for name in MODELS:
+        loaded = registry["models"].get(name)
+        MODEL_RESIDENT_BYTES.set(int(loaded["resident_mb"] * 1024**2) if loaded else 0, model=name)
+        if loaded:
+            MODEL_LOAD_SECONDS.set(loaded["load_seconds"], model=name)
+    for name, count in registry["loads"].items():
+        MODEL_LOADS.set_total(count, model=name)
+    for name, count in registry["evictions"].items():
+        MODEL_EVICTIONS.set_total(count, model=name)
+    caches = [("memory", cache.stats())]
+    if disk_cache:
+        caches.append(("disk", await asyncio.to_thread(disk_cache.stats)))
+    for name, stats in caches:
+        CACHE_ENTRIES.set(stats["entries"], cache=name)
+        CACHE_BYTES.set(stats["bytes"], cache=name)
+        CACHE_HITS.set_total(stats["hits"], cache=name)
+        CACHE_MISSES.set_total(stats["misses"], cache=name)
+        CACHE_EVICTIONS.set_total(stats["evictions"], cache=name)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
-@app.post("/api/correct/batch", response_model=BatchCorrectionResponse, dependencies=[Depends(get_api_key)])
-async def batch_correct(req: BatchCorrectionRequest):
-    results = []
-    for text in req.texts:
+@app.post("/api/correct", response_model=CorrectionResponse, response_model_exclude_none=True)
+async def correct(req: CorrectionRequest, request: Request, response: Response,
+                  client: Client = Depends(get_api_key)):
+    charge(client, 1)
+    result = await unless_disconnected(request, process_text(req.text, generation_params(req.options, req.model), client))
+    with span("encode"):
+        return encode(request, response, await shape_off_loop(result, req.format))
+
+@app.post("/api/correct/incremental", response_model=IncrementalCorrectionResponse, response_model_exclude_none=True)
+async def incremental_correct(req: IncrementalCorrectionRequest, request: Request, response: Response,
+                              client: Client = Depends(get_api_key)):
+    charge(client, 1)
+    checkpoint("validate")
+    require_ready()
+
+    start = time.perf_counter()
+    params = generation_params(req.options, req.model)
+    session_id = req.session_id or uuid.uuid4().hex
+    with span("chunk"):
+        doc = chunk_text(req.text, count_tokens, CHUNK_MAX_TOKENS, merge_sentences=False)
+    previous = sessions.get(session_id)
+    # Only sentences that differ from the previous version (or were corrected
+    # with other options) go to the model
+    keys = [cache_key(sentence, CACHE_MODEL_ID, params) for sentence in doc.texts]
+    corrected = [previous.get(key) for key in keys]
+    changed = [i for i, sentence in enumerate(corrected) if sentence is None]
+    try:
+        outputs = await unless_disconnected(request, correct_chunks([doc.texts[i] for i in changed], params, client)) if changed else []
+    except QueueFull as e:
+        raise busy_error(e)
+    except DeadlineExceeded:
+        raise deadline_error()
+    for i, output in zip(changed, outputs):
+        if isinstance(output, Exception):
+            logger.error(f"Processing error: {output}")
+            raise HTTPException(500, f"Error: {str(output)}")
+        corrected[i] = output
+    sessions.put(session_id, dict(zip(keys, corrected)))
+
+    result = {
+        "success": True,
+        "original": req.text,
+        "corrected": doc.join(corrected),
+        "processing_time_ms": int((time.perf_counter() - start) * 1000),
+        "chars_count": len(req.text),
+        "session_id": session_id,
+        "sentences_total": len(doc.chunks),
+        "sentences_reused": len(doc.chunks) - len(changed)
+    }
+    with span("encode"):
+        return encode(request, response, await shape_off_loop(result, req.format))
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/api/correct/stream")
+async def stream_correct(req: CorrectionRequest, client: Client = Depends(get_api_key)):
+    if req.format != "full":
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, "The stream only sends format 'full'")
+    charge(client, 1)
+    checkpoint("validate")
+    require_ready()
+
+    start = time.perf_counter()
+    with span("chunk"):
+        doc = chunk_text(req.text, count_tokens, CHUNK_MAX_TOKENS, merge_sentences=False)
+    # Only a few batches' worth of sentences are queued at a time, so a long
+    # document neither overflows the queue nor crowds out other requests
+    window = batcher.max_batch_size * batcher.workers * 2
+    try:
+        batcher.admit(min(len(doc.chunks), window), deadline=request_deadline.get())
+    except QueueFull as e:
+        raise busy_error(e)
+    except DeadlineExceeded:
+        raise deadline_error()
+    # One job per sentence: the scheduler still batches them, but earlier
+    # sentences finish in earlier batches and can be sent straight away
+    params = generation_params(req.options, req.model)
+    tasks = []
+
+    def launch(until: int):
+        while len(tasks) < min(until, len(doc.texts)):
+            tasks.append(asyncio.create_task(correct_chunks([doc.texts[len(tasks)]], params, client)))
+
+    launch(window)
+
+    async def events():
+        corrected = []
+        try:
+            for i in range(len(doc.texts)):
+                launch(i + window)
+                output = (await tasks[i])[0]
+                if isinstance(output, Exception):
+                    raise output
+                corrected.append(output)
+                piece = (doc.lead if i == 0 else "") + output + doc.chunks[i][1]
+                yield sse_event("chunk", {"index": i, "total": len(doc.texts), "corrected": piece})
+            yield sse_event("done", {
+                "success": True,
+                "original": req.text,
+                "corrected": doc.join(corrected),
+                "processing_time_ms": int((time.perf_counter() - start) * 1000),
+                "chars_count": len(req.text)
+            })
+        except Exception as e:
+            logger.error(f"Processing error: {e}")
+            yield sse_event("error", {"detail": f"Error: {str(e)}"})
+        finally:
+            # Client went away or a sentence failed: drop whatever is still queued
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def correct_version(websocket: WebSocket, req: SocketCorrectionRequest, client: Client):
+    reply = {"id": req.id, "version": req.version}
+    try:
+        charge(client, 1)
+        result = await process_text(req.text, generation_params(req.options, req.model), client)
+        reply.update(await shape_off_loop(result, req.format))
+    except HTTPException as e:
+        reply.update({"success": False, "status": e.status_code, "detail": e.detail})
+        if e.headers and "Retry-After" in e.headers:
+            reply["retry_after"] = int(e.headers["Retry-After"])
+    await websocket.send_json(reply)
+
+@app.websocket("/ws/correct")
+async def correct_socket(websocket: WebSocket, api_key: Optional[str] = Query(None)):
+    # Browsers can't set headers on a WebSocket, so the key may also come as ?api_key=
+    client = authenticate(websocket.headers.get("x-api-key") or api_key)
+    if client is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid API Key")
+        return
+    await websocket.accept()
+    sockets.add(websocket)
+    # Per field: the newest version seen and the task correcting it
+    latest, tasks = {}, {}
+    try:
+        while True:
+            message = await websocket.receive_text()
+            try:
+                req = SocketCorrectionRequest(**json.loads(message))
+            except (ValueError, TypeError) as e:
+                await websocket.send_json({"success": False, "status": 422, "detail": str(e)})
+                continue
+            if req.id in latest and req.version <= latest[req.id]:
+                # Arrived out of order; a newer version is already being corrected
+                continue
+            latest[req.id] = req.version
+            previous = tasks.pop(req.id, None)
+            if previous and not previous.done():
+                # Queued work for the stale version is dropped, running work stops at the next token
+                previous.cancel()
+                SUPERSEDED.inc()
+            tasks[req.id] = asyncio.create_task(correct_version(websocket, req, client))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sockets.discard(websocket)
+        for task in tasks.values():
+            task.cancel()
+
+@app.post("/api/correct/batch", response_model=BatchCorrectionResponse, response_model_exclude_none=True)
+async def batch_correct(req: BatchCorrectionRequest, request: Request, response: Response,
+                        client: Client = Depends(get_api_key)):
+    charge(client, len(req.texts))
+    checkpoint("validate")
+    start = time.perf_counter()
+    outputs = [None] * len(req.texts)
+    if is_ready():
         try:
-            results.append(process_text(text))
+            # Batches go to the bulk lane so they never hold up single corrections
+            outputs = await unless_disconnected(request, correct_texts(req.texts, generation_params(req.options, req.model), client, "bulk"))
+        except QueueFull as e:
+            raise busy_error(e)
+        except DeadlineExceeded:
+            raise deadline_error()
         except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Batch processing error: {e}")
+    elapsed_ms = int((time.perf_counter() - start) * 1000)
+
+    results = []
+    for text, corrected in zip(req.texts, outputs):
+        if isinstance(corrected, str):
+            results.append({
+                "success": True,
+                "original": text,
+                "corrected": corrected,
+                "processing_time_ms": elapsed_ms,
+                "chars_count": len(text)
+            })
+        else:
             # Fallback for individual item failure in batch
+            ITEM_FAILURES.inc()
             results.append({
                 "success": False,
                 "original": text,
@@ -158,7 +1224,161 @@ async def batch_correct(req: BatchCorrectionRequest):
                 "processing_time_ms": 0,
                 "chars_count": len(text)
             })
-    return {"success": True, "results": results}
+    if req.format == "edits":
+        with span("encode"):
+            # Up to MAX_BATCH_SIZE alignments, so keep them off the event loop
+            results = await asyncio.to_thread(lambda: [shape(result, req.format) for result in results])
+    return encode(request, response, {"success": True, "results": results})
+
+async def run_jobs():
+    while True:
+        try:
+            claimed = await asyncio.to_thread(job_store.claim) if is_ready() else None
+        except Exception as e:
+            logger.error(f"Could not claim a job: {e}")
+            claimed = None
+        if claimed is None:
+            # Other serve.py workers may queue jobs too, so poll as well as wait for our own
+            jobs_submitted.clear()
+            try:
+                await asyncio.wait_for(jobs_submitted.wait(), JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job_id, params, client, weight = claimed
+        try:
+            await run_job(job_id, params, Client(client, weight))
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back so the next start resumes it right away
+            job_store.release(job_id)
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            await asyncio.to_thread(job_store.release, job_id)
+            await asyncio.sleep(JOB_POLL_SECONDS)
+
+async def run_job(job_id: str, params: dict, job_client: Client):
+    logger.info(f"Running job {job_id}")
+    # Jobs run in the lowest priority lane, fair shared by the clients that submitted them
+    limit = JOB_BATCH_SIZE
+    # A batch can wait in the background lane for longer than the lease, so it is
+    # renewed meanwhile; otherwise another worker would take the job over
+    renewer = asyncio.create_task(renew_lease(job_id))
+    try:
+        while True:
+            items = await asyncio.to_thread(job_store.next_items, job_id, limit)
+            if not items:
+                logger.info(f"Job {job_id} finished")
+                return
+            try:
+                outputs = await correct_texts([text for _, text in items], params, job_client, "background")
+            except QueueFull as e:
+                if batcher.lanes["background"].pending:
+                    # Queued work ahead of us drains and makes room
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                if limit > 1:
+                    # The batch alone has more chunks than the queue holds
+                    limit = max(1, limit // 2)
+                    continue
+                # Even one text can't be queued, so retrying would never get anywhere
+                logger.warning(f"Job {job_id}: text {items[0][0]} doesn't fit in the queue, marking it failed")
+                outputs = [e]
+            results = {idx: output if isinstance(output, str) else None for (idx, _), output in zip(items, outputs)}
+            if not await asyncio.to_thread(job_store.complete_items, job_id, results):
+                logger.info(f"Job {job_id} was deleted")
+                return
+    finally:
+        renewer.cancel()
+
+async def renew_lease(job_id: str):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await asyncio.to_thread(job_store.renew, job_id)
+        except Exception as e:
+            logger.warning(f"Could not renew the lease of job {job_id}: {e}")
+
+def require_jobs():
+    if job_store is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Bulk jobs are disabled (set JOBS_DB_PATH)")
+
+def parse_job(body: bytes, content_type: str) -> JobRequest:
+    try:
+        if "ndjson" in content_type or "jsonl" in content_type:
+            # One text per line, either a JSON string or an object with a "text" field
+            lines = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+            return JobRequest(texts=[line if isinstance(line, str) else line["text"] for line in lines])
+        data = json.loads(body)
+        return JobRequest(texts=data) if isinstance(data, list) else JobRequest(**data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Invalid job body: {e}")
+
+@app.post("/api/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(request: Request, client: Client = Depends(get_api_key)):
+    require_jobs()
+    req = parse_job(await request.body(), request.headers.get("content-type", ""))
+    charge(client, len(req.texts))
+    job = await asyncio.to_thread(job_store.create, req.texts, generation_params(req.options, req.model),
+                                  client.name, client.weight)
+    jobs_submitted.set()
+    logger.info(f"Queued job {job['job_id']} with {job['total']} texts")
+    return job
+
+@app.get("/api/jobs/{job_id}", dependencies=[Depends(get_api_key)])
+async def get_job(job_id: str):
+    require_jobs()
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}/results", dependencies=[Depends(get_api_key)])
+async def get_job_results(job_id: str):
+    require_jobs()
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Job not found")
+
+    async def lines():
+        # Whatever has finished so far, in input order, a page at a time
+        after = -1
+        while True:
+            rows = await asyncio.to_thread(job_store.results, job_id, after)
+            if not rows:
+                return
+            for idx, text, corrected, success in rows:
+                yield json.dumps({"index": idx, "success": bool(success), "original": text, "corrected": corrected or ""}) + "\n"
+            after = rows[-1][0]
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Job-Status": job["status"]})
+
+@app.delete("/api/jobs/{job_id}", dependencies=[Depends(get_api_key)])
+async def delete_job(job_id: str):
+    require_jobs()
+    if not await asyncio.to_thread(job_store.delete, job_id):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Job not found")
+    return {"success": True, "job_id": job_id}
+
+@app.post("/admin/profile", response_class=PlainTextResponse, dependencies=[Depends(get_api_key)])
+async def profile(seconds: float = Query(10, gt=0), mode: str = "sample"):
+    if seconds > PROFILE_MAX_SECONDS:
+        raise HTTPException(400, f"Max profiling duration {PROFILE_MAX_SECONDS}s exceeded")
+    try:
+        profiler.start(mode)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except ProfilerBusy as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+    logger.info(f"Profiling inference workers ({mode}) for {seconds}s")
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        # Also runs if the client disconnects, so a session never outlives its request
+        report = profiler.stop()
+    return PlainTextResponse(report, headers={"X-Profile-Mode": mode, "X-Profile-Samples": str(profiler.samples)})
 
 if __name__ == "__main__":
     import uvicorn
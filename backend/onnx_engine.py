@@ -0,0 +1,64 @@
+"""
+ONNX Runtime inference engine.
+
+Exports the seq2seq checkpoint to encoder / decoder / decoder-with-past ONNX
+graphs (the same layout the browser extension runs), optionally applies
+dynamic int8 quantisation, and wraps the result in a regular
+text2text-generation pipeline so the rest of the server is engine-agnostic.
+
+Requires `pip install optimum[onnxruntime]`.
+"""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_SUFFIX = "_quantized"
+
+
+def _exported(directory: str, suffix: str = "") -> bool:
+    return os.path.isfile(os.path.join(directory, f"encoder_model{suffix}.onnx"))
+
+
+def export_onnx(model_path: str, onnx_dir: str, quantize: bool = False) -> str:
+    """Exports model_path to onnx_dir (and an int8 copy to onnx_dir + '-int8') unless already done."""
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    if not _exported(onnx_dir):
+        logger.info(f"Exporting {model_path} to ONNX in {onnx_dir}")
+        model = ORTModelForSeq2SeqLM.from_pretrained(model_path, export=True, use_cache=True)
+        model.save_pretrained(onnx_dir)
+        AutoTokenizer.from_pretrained(model_path).save_pretrained(onnx_dir)
+    if not quantize:
+        return onnx_dir
+
+    int8_dir = f"{onnx_dir}-int8"
+    if not _exported(int8_dir, QUANTIZED_SUFFIX):
+        logger.info(f"Quantising {onnx_dir} to int8 in {int8_dir}")
+        config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        for file_name in sorted(os.listdir(onnx_dir)):
+            if file_name.endswith(".onnx"):
+                quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name=file_name)
+                quantizer.quantize(save_dir=int8_dir, quantization_config=config)
+        AutoTokenizer.from_pretrained(onnx_dir).save_pretrained(int8_dir)
+    return int8_dir
+
+
+def load_onnx_pipeline(model_path: str, onnx_dir: str, quantize: bool = False):
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    from transformers import AutoTokenizer, pipeline
+
+    model_dir = export_onnx(model_path, onnx_dir, quantize)
+    suffix = QUANTIZED_SUFFIX if quantize else ""
+    model = ORTModelForSeq2SeqLM.from_pretrained(
+        model_dir,
+        use_cache=True,
+        encoder_file_name=f"encoder_model{suffix}.onnx",
+        decoder_file_name=f"decoder_model{suffix}.onnx",
+        decoder_with_past_file_name=f"decoder_with_past_model{suffix}.onnx",
+    )
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    return pipeline("text2text-generation", model=model, tokenizer=tokenizer)
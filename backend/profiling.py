@@ -0,0 +1,137 @@
+"""
+On-demand profiling of the inference workers.
+
+A session runs for a fixed number of seconds in one of two modes:
+
+- sample: a background thread snapshots the stacks of the inference threads
+  every few milliseconds and aggregates them as collapsed stacks (one
+  "frame;frame;frame count" line per stack, ready for flamegraph.pl or
+  speedscope).
+- cprofile: batches dispatched during the session run under cProfile and the
+  per-batch profiles are merged into one pstats report. Only one batch is
+  profiled at a time (an interpreter can't run two profilers at once since
+  Python 3.12); batches on other workers meanwhile run unprofiled.
+
+Outside a session the only cost is one attribute check per batch.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from typing import Callable, Optional
+
+MODES = ("sample", "cprofile")
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Profiler:
+    def __init__(self, thread_prefix: str = "inference", interval_ms: float = 5):
+        self.thread_prefix = thread_prefix
+        self.interval = interval_ms / 1000
+        self.mode: Optional[str] = None
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()  # Held by the one batch running under cProfile
+        self._stats: Optional[pstats.Stats] = None
+        self._stacks: Counter = Counter()
+        # Stack snapshots in sample mode, profiled batches in cprofile mode
+        self.samples = 0
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def wrap(self, fn: Callable) -> Callable:
+        """Returns fn instrumented to run under cProfile while a cprofile session is active."""
+        def profiled(*args, **kwargs):
+            if self.mode != "cprofile" or not self._profiling.acquire(blocking=False):
+                return fn(*args, **kwargs)
+            try:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # Some other profiler is active in this interpreter
+                    return fn(*args, **kwargs)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    self._merge(profile)
+            finally:
+                self._profiling.release()
+        return profiled
+
+    def _merge(self, profile: cProfile.Profile):
+        with self._lock:
+            try:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+            except TypeError:
+                # pstats refuses a profile that recorded nothing
+                return
+            self.samples += 1
+
+    def start(self, mode: str):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}, expected one of {', '.join(MODES)}")
+        with self._lock:
+            if self.mode is not None:
+                raise ProfilerBusy(f"A {self.mode} session is already running")
+            self._stats = None
+            self._stacks = Counter()
+            self.samples = 0
+            self.mode = mode
+        if mode == "sample":
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> str:
+        """Ends the session and returns the aggregated profile as text."""
+        mode = self.mode
+        if mode == "sample":
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        with self._lock:
+            self.mode = None
+            if mode == "sample":
+                return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+            if self._stats is None:
+                return "No batches ran during the profiling session.\n"
+            out = io.StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats("cumulative").print_stats(60)
+            return out.getvalue()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            threads = {
+                thread.ident: thread.name for thread in threading.enumerate()
+                if thread.name.startswith(self.thread_prefix)
+            }
+            frames = sys._current_frames()
+            stacks = []
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                # Idle pool threads block inside _worker itself and would swamp the profile
+                if frame.f_code.co_name == "_worker":
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
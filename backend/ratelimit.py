@@ -0,0 +1,58 @@
+"""
+API clients, their scheduling weight and their rate limits.
+
+Keys are configured as API_KEYS=name:key[:weight[:rate[:burst]]],... where
+weight is the client's share of the model under contention (weighted fair
+queuing in the scheduler) and rate/burst parametrise a token bucket counted
+in texts per second. A rate of 0 means unlimited.
+"""
+
+import time
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """Takes cost tokens and returns 0, or returns how many seconds until they would be available."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request bigger than the burst could never fit, so it is let through
+        # once the bucket is full and leaves it in debt for the rest
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+
+class Client:
+    def __init__(self, name: str, weight: float = 1.0, rate: float = 0.0, burst: Optional[float] = None):
+        self.name = name
+        self.weight = max(weight, 0.01)
+        self.bucket = TokenBucket(rate, burst if burst is not None else rate * 2)
+
+
+def parse_api_keys(spec: str, default_rate: float = 0.0, default_burst: Optional[float] = None) -> Dict[str, Client]:
+    """Returns key -> Client for an API_KEYS value."""
+    clients = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        parts = entry.strip().split(":")
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            raise ValueError(f"Invalid API_KEYS entry {entry.strip()!r}, expected name:key[:weight[:rate[:burst]]]")
+        name, key = parts[0], parts[1]
+        weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+        rate = float(parts[3]) if len(parts) > 3 and parts[3] else default_rate
+        burst = float(parts[4]) if len(parts) > 4 and parts[4] else default_burst
+        clients[key] = Client(name, weight, rate, burst)
+    return clients
@@ -0,0 +1,148 @@
+"""
+Registry of correction models that are loaded on demand.
+
+Besides the default model (loaded at startup and pinned), a deployment can
+serve further checkpoints that requests ask for by name. They are loaded the
+first time they are needed, concurrent requests for a model that is still
+loading wait for that one load instead of starting their own, and loaded
+models stay resident within a memory budget: once the total goes over it the
+least recently used unpinned models are dropped (and reloaded if asked for
+again).
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+def resident_bytes(pipe) -> Optional[int]:
+    """Size of a PyTorch pipeline's weights and buffers; None for other engines."""
+    model = getattr(pipe, "model", None)
+    if not hasattr(model, "parameters"):
+        return None
+    return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+
+class Entry:
+    __slots__ = ("pipe", "bytes", "load_seconds", "loaded_at", "last_used", "uses", "pinned")
+
+    def __init__(self, pipe, size: int, load_seconds: float, pinned: bool = False):
+        self.pipe = pipe
+        self.bytes = size
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.uses = 0
+        self.pinned = pinned
+
+
+class ModelRegistry:
+    def __init__(self, loader: Callable[[str], Any], budget_bytes: int = 0):
+        # loader(name) returns a ready pipeline; budget_bytes of 0 means no limit
+        self.loader = loader
+        self.budget = budget_bytes
+        self._lock = threading.Lock()
+        self._models: "OrderedDict[str, Entry]" = OrderedDict()  # least recently used first
+        self._loading: Dict[str, Future] = {}
+        self.loads: Dict[str, int] = {}
+        self.evictions: Dict[str, int] = {}
+
+    def add(self, name: str, pipe, load_seconds: float = 0.0, pinned: bool = False):
+        """Registers an already loaded pipeline (e.g. the default model)."""
+        with self._lock:
+            self._models[name] = Entry(pipe, resident_bytes(pipe) or 0, load_seconds, pinned)
+            self.loads[name] = self.loads.get(name, 0) + 1
+
+    def loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def get(self, name: str):
+        """Returns the pipeline for name, loading it (once, however many callers ask) if needed."""
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+                entry.last_used = time.time()
+                entry.uses += 1
+                return entry.pipe
+            future = self._loading.get(name)
+            owner = future is None
+            if owner:
+                future = self._loading[name] = Future()
+        if not owner:
+            return future.result()
+        try:
+            pipe = self._load(name)
+            future.set_result(pipe)
+            return pipe
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(name, None)
+
+    def _load(self, name: str):
+        logger.info(f"Loading model {name}")
+        rss = psutil.Process().memory_info().rss
+        start = time.perf_counter()
+        pipe = self.loader(name)
+        seconds = time.perf_counter() - start
+        # ONNX sessions don't expose their weights, so fall back to how much the process grew
+        size = resident_bytes(pipe) or max(0, psutil.Process().memory_info().rss - rss)
+        logger.info(f"Loaded model {name} in {seconds:.2f}s ({size / 1024**2:.0f} MB)")
+        with self._lock:
+            entry = Entry(pipe, size, seconds)
+            entry.uses = 1
+            self._models[name] = entry
+            self.loads[name] = self.loads.get(name, 0) + 1
+            self._evict(keep=name)
+        return pipe
+
+    def _evict(self, keep: str):
+        # Called with the lock held; in-flight batches keep their reference until they finish
+        total = sum(entry.bytes for entry in self._models.values())
+        for name in list(self._models):
+            if not self.budget or total <= self.budget:
+                break
+            entry = self._models[name]
+            if entry.pinned or name == keep:
+                continue
+            del self._models[name]
+            total -= entry.bytes
+            self.evictions[name] = self.evictions.get(name, 0) + 1
+            logger.info(f"Evicted model {name} ({entry.bytes / 1024**2:.0f} MB) to stay within the memory budget")
+        if self.budget and total > self.budget:
+            logger.warning(f"Resident models take {total / 1024**2:.0f} MB, over the "
+                           f"{self.budget / 1024**2:.0f} MB budget, but none can be evicted")
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = {
+                name: {
+                    "resident_mb": round(entry.bytes / 1024**2, 2),
+                    "load_seconds": round(entry.load_seconds, 2),
+                    "loaded_at": entry.loaded_at,
+                    "last_used": entry.last_used,
+                    "uses": entry.uses,
+                    "pinned": entry.pinned,
+                }
+                for name, entry in self._models.items()
+            }
+            loading = list(self._loading)
+        return {
+            "budget_mb": round(self.budget / 1024**2, 2) if self.budget else None,
+            "resident_mb": round(sum(model["resident_mb"] for model in models.values()), 2),
+            "models": models,
+            "loading": loading,
+            "loads": dict(self.loads),
+            "evictions": dict(self.evictions),
+        }
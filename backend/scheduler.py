@@ -0,0 +1,369 @@
+"""
+Request scheduler for the correction model.
+
+Concurrent requests are collected into a shared queue and handed to the model
+as one batch, so N callers arriving together cost one generate call instead
+of N. A request is a list of texts (one for /api/correct, many for
+/api/correct/batch); the generate callable returns one result per text, either
+the corrected string or the exception that text failed with. Batches run on a
+dedicated thread pool so the event loop stays responsive, and admission is
+bounded: when the queue is full callers get QueueFull immediately instead of
+waiting behind everyone else.
+
+Jobs are queued in priority lanes (interactive before bulk before
+background), each with its own admission limit, so bulk traffic can neither
+delay nor crowd out interactive requests. Within a lane, clients share the
+model by weighted fair queuing: every job gets a virtual finish time of
+max(lane clock, the client's previous finish) + texts / weight, and the
+earliest finish time goes next.
+
+A job may carry a deadline (a time.perf_counter() value, or a Deadline that
+other callers sharing the job's results can push back). It is refused at
+admission when the queue ahead of it can't be drained in time, failed with
+DeadlineExceeded if it expires while queued, and (with greedy decoding) its
+rows are cut short at the next decoding step once it expires mid-generation.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+LANES = ("interactive", "bulk", "background")
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self):
+        super().__init__("Request deadline exceeded")
+
+
+class Deadline:
+    """A deadline shared by everyone waiting on a job: it lasts as long as the latest of them needs."""
+    __slots__ = ("at",)
+
+    def __init__(self, at: Optional[float] = None):
+        self.at = at  # time.perf_counter() value; None for no deadline
+
+    def extend(self, at: Optional[float]) -> bool:
+        """Pushes the deadline back to at; False if it has passed already, as rows may have been cut short."""
+        if self.passed():
+            return False
+        if self.at is not None:
+            self.at = None if at is None else max(self.at, at)
+        return True
+
+    def passed(self, now: Optional[float] = None) -> bool:
+        return self.at is not None and (now or time.perf_counter()) > self.at
+
+
+Result = Union[str, Exception]
+# generate(texts, timings, params, abandoned) fills timings with seconds spent per
+# stage of the batch; params holds each text's generation parameters (None for
+# defaults) and abandoned(i) tells whether text i's caller has gone away (or its
+# deadline passed) since
+Generate = Callable[[List[str], Dict[str, float], List[Optional[dict]], Callable[[int], bool]], List[Result]]
+# Called after every batch with (lane, queue wait) of each job, the number of texts and the inference time
+BatchObserver = Callable[[List[Tuple[str, float]], int, float], None]
+
+
+class Job:
+    __slots__ = ("texts", "future", "enqueued_at", "timings", "params", "lane", "start_tag", "deadline")
+
+    def __init__(self, texts: List[str], future: asyncio.Future, timings: Optional[Dict[str, float]] = None,
+                 params: Optional[dict] = None, lane: str = "interactive", deadline: Optional[Deadline] = None):
+        self.texts = texts
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+        self.timings = timings
+        self.params = params
+        self.lane = lane
+        self.start_tag = 0.0
+        self.deadline = deadline or Deadline()
+
+    def expired(self, now: Optional[float] = None) -> bool:
+        return self.deadline.passed(now)
+
+    def record(self, stage: str, seconds: float):
+        if self.timings is not None:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+
+class Lane:
+    def __init__(self, name: str):
+        self.name = name
+        self.heap: List[tuple] = []
+        self.pending = 0
+        self.clock = 0.0
+        self.finish: Dict[str, float] = {}  # client -> virtual finish time of its last queued job
+        self.avg_wait = 0.0
+        self.waits = 0
+
+    def push(self, job: Job, client: str, weight: float, seq: int):
+        job.start_tag = max(self.clock, self.finish.get(client, 0.0))
+        finish = job.start_tag + len(job.texts) / weight
+        self.finish[client] = finish
+        heapq.heappush(self.heap, (finish, seq, job))
+        self.pending += len(job.texts)
+
+    def pop(self) -> Optional[Job]:
+        if not self.heap:
+            return None
+        _, _, job = heapq.heappop(self.heap)
+        self.pending -= len(job.texts)
+        self.clock = max(self.clock, job.start_tag)
+        if not self.heap:
+            # Nobody is backlogged any more, so past usage stops counting
+            self.finish.clear()
+        return job
+
+    def observe_wait(self, wait: float):
+        self.avg_wait = wait if not self.waits else 0.9 * self.avg_wait + 0.1 * wait
+        self.waits += 1
+
+
+class MicroBatcher:
+    def __init__(self, generate: Generate, max_batch_size: int = 8, max_wait_ms: int = 10,
+                 workers: int = 1, max_queue_size: int = 64, on_batch: Optional[BatchObserver] = None,
+                 measure: Optional[Callable[[List[str]], List[int]]] = None):
+        self.generate = generate
+        # Sizes texts (e.g. in tokens) so slices of a bulk job hold texts of similar length
+        self.measure = measure or (lambda texts: [len(text) for text in texts])
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.workers = max(1, workers)
+        # Per lane, so a bulk backlog never makes interactive requests bounce
+        self.max_queue_size = max(1, max_queue_size)
+        self.on_batch = on_batch
+        self.lanes = {name: Lane(name) for name in LANES}
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self.busy = 0
+        self.rejected = 0
+        self.dropped = 0
+        # Texts that missed their deadline, by where it was noticed
+        self.expired = {"admission": 0, "queue": 0, "generation": 0}
+        # Inference time spent on texts whose result was thrown away
+        self.wasted_seconds = 0.0
+        self.batches = 0
+        self.avg_batch_seconds = 0.0
+        self._seq = itertools.count()
+        self._queued = None
+        self._slots = None
+        self._task = None
+        self._dispatching = set()
+
+    @property
+    def pending(self) -> int:
+        return sum(lane.pending for lane in self.lanes.values())
+
+    def start(self):
+        if self._task is None:
+            self._queued = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.workers)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def expected_wait(self, lane: str = "interactive") -> float:
+        # Rough time to drain what is queued at this priority or above, assuming full batches on every worker
+        ahead = sum(self.lanes[name].pending for name in LANES[:LANES.index(lane) + 1])
+        rounds = math.ceil(ahead / (self.max_batch_size * self.workers))
+        return rounds * self.avg_batch_seconds
+
+    def retry_after(self, lane: str = "interactive") -> int:
+        return max(1, math.ceil(self.expected_wait(lane)))
+
+    def admit(self, count: int = 1, lane: str = "interactive", deadline: Optional[float] = None):
+        # A job bigger than the whole queue is let into an empty lane; refusing
+        # it would send the client a 503 it could retry forever
+        pending = self.lanes[lane].pending
+        if pending and pending + count > self.max_queue_size:
+            self.rejected += 1
+            raise QueueFull(self.retry_after(lane))
+        # Queueing work that can't finish in time would only delay everyone else
+        if deadline is not None and time.perf_counter() + self.expected_wait(lane) + self.avg_batch_seconds > deadline:
+            self.expired["admission"] += count
+            raise DeadlineExceeded()
+
+    async def submit(self, texts: List[str], timings: Optional[Dict[str, float]] = None,
+                     params: Optional[dict] = None, lane: str = "interactive",
+                     client: str = "", weight: float = 1.0,
+                     deadline: Union[float, Deadline, None] = None) -> List[Result]:
+        """Queues texts as one job; timings, if given, accumulates queue and model stage durations.
+
+        Jobs with different params still share a batch; generate is expected to
+        group texts by params itself. client and weight set the job's fair share
+        within its lane; past deadline the job fails with DeadlineExceeded.
+        Bulk and background texts are queued in batch-sized slices, so an
+        interactive request never waits behind more than one batch of them;
+        they are sliced shortest first, so each slice pads to its own length.
+        """
+        if not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        self.admit(len(texts), lane, deadline.at)
+        loop = asyncio.get_running_loop()
+        if lane == "interactive":
+            order, size = list(range(len(texts))), max(1, len(texts))
+        else:
+            order, size = sorted(range(len(texts)), key=self.measure(texts).__getitem__), self.max_batch_size
+        jobs = []
+        for start in range(0, len(texts), size):
+            job = Job([texts[i] for i in order[start:start + size]], loop.create_future(), timings, params, lane,
+                      deadline)
+            self.lanes[lane].push(job, client, weight, next(self._seq))
+            jobs.append(job)
+        self._queued.set()
+        try:
+            parts = await asyncio.gather(*(job.future for job in jobs))
+        except BaseException:
+            # The caller gets nothing from the remaining slices now
+            for job in jobs:
+                job.future.cancel()
+            raise
+        results = [None] * len(texts)
+        for i, result in zip(order, (result for part in parts for result in part)):
+            results[i] = result
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.pending,
+            "queue_capacity": self.max_queue_size,
+            "workers": self.workers,
+            "busy_workers": self.busy,
+            "utilisation": round(self.busy / self.workers, 2),
+            "batches": self.batches,
+            "avg_batch_ms": round(self.avg_batch_seconds * 1000, 1),
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "expired": dict(self.expired),
+            "wasted_seconds": round(self.wasted_seconds, 3),
+            "lanes": {
+                name: {"queue_depth": lane.pending, "avg_wait_ms": round(lane.avg_wait * 1000, 1)}
+                for name, lane in self.lanes.items()
+            },
+        }
+
+    def _next(self) -> Optional[Job]:
+        for name in LANES:
+            job = self.lanes[name].pop()
+            if job is not None:
+                return job
+        return None
+
+    async def _wait_queued(self, timeout: Optional[float] = None) -> bool:
+        self._queued.clear()
+        try:
+            await asyncio.wait_for(self._queued.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _collect(self) -> List[Job]:
+        loop = asyncio.get_running_loop()
+        first = self._next()
+        while first is None:
+            await self._wait_queued()
+            first = self._next()
+        batch = [first]
+        size = len(first.texts)
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            # Highest priority first, so a waiting interactive job always beats bulk
+            job = self._next()
+            if job is None:
+                timeout = deadline - loop.time()
+                if timeout <= 0 or not await self._wait_queued(timeout):
+                    break
+                continue
+            batch.append(job)
+            size += len(job.texts)
+        # Callers that went away while queued don't need a result
+        live = [job for job in batch if not job.future.done()]
+        self.dropped += size - sum(len(job.texts) for job in live)
+        now = time.perf_counter()
+        for job in live:
+            if job.expired(now):
+                self.expired["queue"] += len(job.texts)
+                job.future.set_exception(DeadlineExceeded())
+        return [job for job in live if not job.future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Only pull a batch off the queue once a worker can take it, so
+            # requests keep accumulating (and batching up) while all are busy
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            if not batch:
+                self._slots.release()
+                continue
+            task = loop.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: List[Job]):
+        loop = asyncio.get_running_loop()
+        texts = [text for job in batch for text in job.texts]
+        params = [job.params for job in batch for _ in job.texts]
+        owners = [job for job in batch for _ in job.texts]
+        self.busy += 1
+        start = time.perf_counter()
+        waits = [(job.lane, start - job.enqueued_at) for job in batch]
+        stages: Dict[str, float] = {}
+        try:
+            outputs = await loop.run_in_executor(self.executor, self.generate, texts, stages, params,
+                                               lambda i: owners[i].future.done() or owners[i].expired())
+        except Exception as e:
+            logger.error(f"Batch of {len(texts)} failed: {e}")
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        finally:
+            elapsed = time.perf_counter() - start
+            self.avg_batch_seconds = elapsed if not self.batches else 0.8 * self.avg_batch_seconds + 0.2 * elapsed
+            self.batches += 1
+            self.busy -= 1
+            self._slots.release()
+            for job, (lane, wait) in zip(batch, waits):
+                self.lanes[lane].observe_wait(wait)
+                job.record("queue", wait)
+                for stage, seconds in stages.items():
+                    job.record(stage, seconds)
+            if self.on_batch:
+                self.on_batch(waits, len(texts), elapsed)
+        # Rows of jobs that expired meanwhile may have been cut short, so their output is discarded
+        now = time.perf_counter()
+        wasted = 0
+        offset = 0
+        for job in batch:
+            if job.future.done():
+                wasted += len(job.texts)
+            elif job.expired(now):
+                wasted += len(job.texts)
+                self.expired["generation"] += len(job.texts)
+                job.future.set_exception(DeadlineExceeded())
+            else:
+                job.future.set_result(outputs[offset:offset + len(job.texts)])
+            offset += len(job.texts)
+        self.wasted_seconds += elapsed * wasted / len(texts)
@@ -0,0 +1,104 @@
+"""
+Prefork server: load the model once, then fork worker processes.
+
+Usage: python serve.py   (configured through WORKERS, THREADS_PER_WORKER, HOST, PORT)
+
+The parent process loads the PyTorch weights and forks WORKERS uvicorn
+workers that all accept on one shared socket. Forked children share the
+weight pages copy-on-write, so adding a worker costs its activations and
+caches rather than another copy of the model. Each worker is limited to
+THREADS_PER_WORKER intra-op threads so the workers together don't
+oversubscribe the CPUs.
+"""
+
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+
+import psutil
+import uvicorn
+
+import main
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("WORKERS", "2"))
+THREADS_PER_WORKER = int(os.getenv("THREADS_PER_WORKER", "0")) or max(1, psutil.cpu_count() // WORKERS)
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+
+
+def run_worker(worker_id: int, sock: socket.socket):
+    os.environ["WORKER_ID"] = str(worker_id)
+    torch = sys.modules.get("torch")
+    if torch:
+        torch.set_num_threads(THREADS_PER_WORKER)
+    config = uvicorn.Config(main.app, log_level="info")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn(worker_id: int, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(worker_id, sock)
+        except BaseException:
+            logger.exception(f"Worker {worker_id} crashed")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def serve():
+    if main.INFERENCE_ENGINE == "pytorch":
+        # Load before forking; the parent never runs inference so no torch
+        # thread pools exist yet that could break in the children
+        main.load_model()
+        gc.collect()
+        gc.freeze()  # keep the collector from touching (and un-sharing) the model's pages
+    else:
+        logger.warning(f"{main.INFERENCE_ENGINE} sessions cannot cross a fork; each worker loads its own copy")
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    logger.info(f"Serving on {HOST}:{PORT} with {WORKERS} workers x {THREADS_PER_WORKER} threads")
+
+    workers = {spawn(worker_id, sock): worker_id for worker_id in range(WORKERS)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = workers.pop(pid, None)
+        if worker_id is not None and not stopping:
+            logger.warning(f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting")
+            workers[spawn(worker_id, sock)] = worker_id
+    sock.close()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,38 @@
+"""
+Per-document state for incremental re-correction.
+
+Each session remembers the corrected form of every sentence in the last
+version of its document (keyed like the correction cache, so changing the
+generation options invalidates them), so a follow-up request only has to run
+the model on sentences that were edited.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: float = 1800):
+        self.max_sessions = max_sessions
+        self.ttl = ttl_seconds
+        self._sessions: OrderedDict = OrderedDict()  # session_id -> (sentences, last_seen)
+
+    def get(self, session_id: str) -> Dict[str, str]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return {}
+        sentences, last_seen = entry
+        if self.ttl and last_seen + self.ttl < time.monotonic():
+            del self._sessions[session_id]
+            return {}
+        return sentences
+
+    def put(self, session_id: str, sentences: Dict[str, str]):
+        self._sessions[session_id] = (sentences, time.monotonic())
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,111 @@
+"""
+Copy-aware speculative decoding for the seq2seq corrector.
+
+A grammar correction is mostly a verbatim copy of its input, so instead of
+one decoder pass per token the input itself is used as the draft (prompt
+lookup): the last few generated tokens are located in the source, the tokens
+that follow them there are proposed, and a single decoder pass verifies the
+whole draft. The longest prefix that matches the model's own greedy choice is
+kept, plus the model's token at the first mismatch, and the self-attention
+cache is cropped back to the accepted length. When nothing in the source
+matches, a step degrades to ordinary one-token greedy decoding.
+
+The result is the same token sequence greedy generate() produces (up to
+floating-point ties between equally likely tokens). PyTorch models only.
+"""
+
+from typing import Callable, List, Optional
+
+import torch
+
+DRAFT_TOKENS = 8
+MAX_NGRAM = 3
+
+
+def propose(source: List[int], generated: List[int], draft_tokens: int = DRAFT_TOKENS,
+            max_ngram: int = MAX_NGRAM) -> List[int]:
+    """Returns the source tokens that followed the latest occurrence of the generated suffix."""
+    if not generated:
+        # Corrections usually start the way the input does
+        return source[:draft_tokens]
+    for n in range(min(max_ngram, len(generated)), 0, -1):
+        suffix = generated[-n:]
+        for start in range(len(source) - n, -1, -1):
+            if source[start:start + n] == suffix:
+                follow = source[start + n:start + n + draft_tokens]
+                if follow:
+                    return follow
+    return []
+
+
+@torch.inference_mode()
+def _decode_one(model, encoder_hidden_states, attention_mask, source: List[int], max_new_tokens: int,
+                stats: dict, stop: Optional[Callable[[], bool]] = None) -> List[int]:
+    from transformers.cache_utils import DynamicCache, EncoderDecoderCache
+    from transformers.modeling_outputs import BaseModelOutput
+
+    config = model.config
+    eos = config.eos_token_id
+    encoder_outputs = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+    past = EncoderDecoderCache(DynamicCache(), DynamicCache())
+    sequence = [config.decoder_start_token_id]
+    generated: List[int] = []
+    while len(generated) < max_new_tokens:
+        if stop is not None and stop():
+            break
+        # Never draft past the budget: the bonus token takes the last slot
+        draft = propose(source, generated)[:max_new_tokens - len(generated) - 1]
+        feed = torch.tensor([[sequence[-1]] + draft], dtype=torch.long)
+        logits = model(
+            encoder_outputs=encoder_outputs,
+            attention_mask=attention_mask,
+            decoder_input_ids=feed,
+            past_key_values=past,
+            use_cache=True,
+        ).logits[0]
+        predicted = logits.argmax(-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and predicted[accepted] == draft[accepted]:
+            accepted += 1
+        stats["drafted"] = stats.get("drafted", 0) + len(draft)
+        stats["accepted"] = stats.get("accepted", 0) + accepted
+        stats["steps"] = stats.get("steps", 0) + 1
+        new_tokens = draft[:accepted] + [predicted[accepted]]
+        if eos in new_tokens:
+            new_tokens = new_tokens[:new_tokens.index(eos) + 1]
+        sequence.extend(new_tokens)
+        generated.extend(new_tokens)
+        if new_tokens[-1] == eos:
+            break
+        # Drop the cache entries of rejected draft tokens; the last token is fed next step
+        past.crop(len(sequence) - 1)
+    return sequence
+
+
+def speculative_generate(model, input_ids: torch.Tensor, attention_mask: torch.Tensor, max_new_tokens: int,
+                         stats: Optional[dict] = None,
+                         abandoned: Optional[Callable[[int], bool]] = None) -> torch.Tensor:
+    """Greedy decoding of a (padded) batch, one row at a time, with copy drafts.
+
+    Rows for which abandoned(row) is true when their turn comes are not
+    decoded, and a row being decoded stops at the next step once it is.
+    Returns decoder token ids padded with pad_token_id, shaped like
+    generate()'s output.
+    """
+    stats = {} if stats is None else stats
+    with torch.inference_mode():
+        hidden = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+    sequences = []
+    for row in range(input_ids.shape[0]):
+        if abandoned and abandoned(row):
+            sequences.append([model.config.decoder_start_token_id])
+            continue
+        length = int(attention_mask[row].sum())
+        source = input_ids[row, :length].tolist()
+        sequences.append(_decode_one(
+            model, hidden[row:row + 1, :length], attention_mask[row:row + 1, :length], source, max_new_tokens, stats,
+            (lambda row=row: abandoned(row)) if abandoned else None
+        ))
+    width = max(len(sequence) for sequence in sequences)
+    pad = model.config.pad_token_id
+    return torch.tensor([sequence + [pad] * (width - len(sequence)) for sequence in sequences], dtype=torch.long)
@@ -0,0 +1,38 @@
+"""
+Fork-safe SQLite connection for the stores shared by every worker process.
+
+The disk cache and the job store both keep their data in a SQLite database
+in WAL mode, so every serve.py worker can read and write it concurrently.
+SQLite connections must not cross a fork, so each process lazily opens its
+own the first time it needs one and sets up the schema on it.
+"""
+
+import os
+import sqlite3
+from typing import Callable, Optional
+
+
+class LazyConnection:
+    def __init__(self, path: str, setup: Callable[[sqlite3.Connection], None]):
+        # setup(conn) creates (or migrates) the schema on every newly opened connection
+        self.path = path
+        self.setup = setup
+        self._pid: Optional[int] = None
+        self._db: Optional[sqlite3.Connection] = None
+
+    def get(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.setup(db)
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def close(self):
+        # A connection inherited over a fork belongs to the parent, so it is only forgotten
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+        self._pid = None
@@ -0,0 +1,32 @@
+"""
+Early stopping for rows nobody is waiting for any more.
+
+A dispatched batch mixes texts from several requests. When one of them is
+cancelled mid-generation (its WebSocket field got a newer version, or the
+client disconnected) its rows are marked finished at the next decoder step,
+so they stop costing compute while the rest of the batch carries on.
+
+Greedy decoding only: beam search finishes a batch only once every row is
+flagged, so abandoned rows would keep decoding anyway.
+"""
+
+from typing import Callable, Set
+
+import torch
+from transformers import StoppingCriteria
+
+
+class Abandoned(StoppingCriteria):
+    def __init__(self, abandoned: Callable[[int], bool]):
+        self.abandoned = abandoned
+        self.stopped: Set[int] = set()
+
+    def check(self, row: int) -> bool:
+        if self.abandoned(row):
+            self.stopped.add(row)
+            return True
+        return False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = [self.check(row) for row in range(input_ids.shape[0])]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
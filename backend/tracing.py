@@ -0,0 +1,98 @@
+"""
+Per-request stage timings.
+
+Every HTTP request gets a Trace that the endpoints and the inference path add
+named stage durations to (validate, chunk, cache, queue, tokenize, generate,
+detokenize). The stages are returned to the client as a Server-Timing header
+and a configurable fraction of requests is appended as JSON lines to a local
+file, so slow requests can be broken down in production without a profiler.
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+
+def add_stage(stages: Dict[str, float], name: str, seconds: float):
+    stages[name] = stages.get(name, 0.0) + seconds
+
+
+class Trace:
+    def __init__(self, sampled: bool = False):
+        self.id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self._mark = self.started
+
+    def checkpoint(self, name: str):
+        """Attributes everything since the previous checkpoint (or the start) to name."""
+        now = time.perf_counter()
+        add_stage(self.stages, name, now - self._mark)
+        self._mark = now
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            add_stage(self.stages, name, time.perf_counter() - start)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def to_dict(self, **fields) -> dict:
+        return {
+            "trace_id": self.id,
+            "timestamp": self.timestamp,
+            **fields,
+            "total_ms": round(self.elapsed() * 1000, 2),
+            "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+        }
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Times the block into the current request's trace, if there is one."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+def checkpoint(name: str):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.checkpoint(name)
+
+
+class TraceWriter:
+    def __init__(self, path: str, sample_rate: float = 0.0):
+        self.path = path
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self._lock = threading.Lock()
+
+    def start(self) -> Trace:
+        return Trace(sampled=self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
@@ -0,0 +1,59 @@
+"""
+Pre-populate the on-disk correction cache (DISK_CACHE_PATH).
+
+Usage: python warm_cache.py <file> [<file> ...] [--field incorrect] [--batch-size 32]
+
+JSON files may hold a list of strings or of objects (the text is read from
+--field, e.g. metrics/data/grammar_benchmark.json); any other file is read as
+one text per non-empty line.
+"""
+
+import argparse
+import json
+
+import main
+
+
+def read_texts(path, field):
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return [item if isinstance(item, str) else item[field] for item in data
+                if isinstance(item, str) or field in item]
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def warm(paths, field, batch_size):
+    if not main.disk_cache:
+        print("DISK_CACHE_PATH is not set, nothing to warm")
+        return 1
+    main.load_model()
+    if not main.corrector:
+        return 1
+
+    chunks = []
+    for path in paths:
+        for text in read_texts(path, field):
+            chunks.extend(main.split_text(text).texts)
+    keys = {main.cache_key(chunk, main.CACHE_MODEL_ID, main.GENERATION_PARAMS): chunk for chunk in chunks}
+    cached = main.disk_cache.get_many(list(keys))
+    todo = [(key, chunk) for key, chunk in keys.items() if key not in cached]
+    print(f"{len(keys)} unique chunks, {len(cached)} already cached, {len(todo)} to generate")
+
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        outputs = main.generate([chunk for _, chunk in batch])
+        main.disk_cache.put_many({key: out for (key, _), out in zip(batch, outputs) if isinstance(out, str)})
+        print(f"  {min(start + batch_size, len(todo))}/{len(todo)}")
+    print(f"Warmed {main.DISK_CACHE_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-populate the on-disk correction cache")
+    parser.add_argument("files", nargs="+", help="JSON or text files with texts to correct")
+    parser.add_argument("--field", default="incorrect", help="Key to read from JSON objects (default: incorrect)")
+    parser.add_argument("--batch-size", type=int, default=32, help="Texts per generate call")
+    args = parser.parse_args()
+    exit(warm(args.files, args.field, args.batch_size))
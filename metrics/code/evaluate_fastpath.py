@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measure the already-correct fast path (FASTPATH_THRESHOLD) on a grammar benchmark.
+Usage: python evaluate_fastpath.py <benchmark.json> [--model <path>] [--thresholds 0.5,0.9,0.99] [--output <results.json>]
+
+Every 'correct' sentence should be skipped (saved generations) and every
+'incorrect' one should not (a false skip returns the error uncorrected, so it
+costs accuracy).
+"""
+
+import json
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend'))
+
+from fastpath import identity_scores
+
+def score_texts(model, tokenizer, texts, batch_size=16):
+    scores = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        inputs = tokenizer([f"grammar: {text}" for text in batch], padding=True, truncation=True, max_length=512, return_tensors='pt')
+        targets = tokenizer(batch, padding=True, truncation=True, max_length=512, return_tensors='pt')
+        scores.extend(identity_scores(model, inputs, targets))
+    return scores
+
+def evaluate_fastpath(benchmark_file, model_path, thresholds, output_file=None):
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+    with open(benchmark_file, 'r') as f:
+        data = json.load(f)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path).eval()
+    correct_scores = score_texts(model, tokenizer, [item['correct'] for item in data])
+    incorrect_scores = score_texts(model, tokenizer, [item['incorrect'] for item in data])
+
+    total = len(data)
+    rows = []
+    for threshold in thresholds:
+        skipped = sum(1 for score in correct_scores if score >= threshold)
+        false_skips = [item for item, score in zip(data, incorrect_scores) if score >= threshold]
+        rows.append({
+            'threshold': threshold,
+            'correct_skipped': skipped,
+            'skip_rate': round(skipped / total * 100, 2) if total > 0 else 0,
+            'incorrect_skipped': len(false_skips),
+            'accuracy_loss': round(len(false_skips) / total * 100, 2) if total > 0 else 0,
+            'false_skips': [{'incorrect': item['incorrect'], 'category': item.get('category', 'Unknown')} for item in false_skips]
+        })
+
+    print("=" * 60)
+    print("FAST PATH EVALUATION")
+    print("=" * 60)
+    print(f"\n{total} sentence pairs, model: {model_path}")
+    print("\nthreshold  correct skipped  incorrect skipped (accuracy loss)")
+    print("-" * 60)
+    for row in rows:
+        print(f"  {row['threshold']:<8} {row['correct_skipped']:>4}/{total} ({row['skip_rate']}%)"
+              f"   {row['incorrect_skipped']:>4}/{total} ({row['accuracy_loss']}%)")
+    print("=" * 60)
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump({
+                'model': model_path,
+                'total': total,
+                'thresholds': rows,
+                'scores': [{'sl': item.get('sl', i + 1), 'correct': c, 'incorrect': w}
+                           for i, (item, c, w) in enumerate(zip(data, correct_scores, incorrect_scores))]
+            }, f, indent=2)
+        print(f"\nResults saved to {output_file}")
+
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure skip rate and accuracy cost of the already-correct fast path')
+    parser.add_argument('benchmark', help='Benchmark JSON file with incorrect/correct pairs')
+    parser.add_argument('--model', default=os.getenv('MODEL_NAME', 'vennify/t5-base-grammar-correction'), help='Model name or local path')
+    parser.add_argument('--thresholds', default='0.5,0.7,0.8,0.9,0.95,0.99', help='Comma-separated thresholds to evaluate')
+    parser.add_argument('--output', '-o', help='Output results JSON file (optional)')
+    args = parser.parse_args()
+
+    evaluate_fastpath(args.benchmark, args.model, [float(t) for t in args.thresholds.split(',')], args.output)